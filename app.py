@@ -5,14 +5,2604 @@ from tkinter import (
     ttk, scrolledtext, messagebox, 
     filedialog, simpledialog
 )
-from datetime import datetime
-from threading import Thread
+from datetime import datetime, timedelta, timezone
+from threading import Thread, Lock, Event, get_ident
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import multiprocessing
+import queue
+import asyncio
+import argparse
+import sys
+import urllib.parse
 import google.generativeai as genai
-import matplotlib.pyplot as plt
 import re
 import io
+import hashlib
+import sqlite3
+import bisect
+import time
+import html
+import base64
+import enum
+import tracemalloc
+import zlib
+import mimetypes
 from PIL import Image, ImageTk # Import Pillow for image handling
 from pathlib import Path
+from collections import OrderedDict
+
+# Regex to split by LaTeX delimiters, compiled once for all messages
+LATEX_PATTERN = re.compile(r'(\$\$[^$]+\$\$|\$[^$]+\$)')
+# Maksymalna liczba wyrenderowanych formuł trzymanych w pamięci
+LATEX_CACHE_SIZE = 512
+# Ustawienia renderowania formuł w oknie czatu; ich zmiana unieważnia zapisane paczki formuł
+LATEX_DPI = 150
+LATEX_FONT_FAMILY = 'serif'
+LATEX_FONT_SERIF = 'Computer Modern Roman' # Or 'Latin Modern Roman'
+LATEX_FONT_SIZE_INLINE = 14
+LATEX_FONT_SIZE_BLOCK = 18
+# Paczka PNG formuł zapisywana obok pliku konwersacji
+FORMULA_BUNDLE_EXTENSION = ".formulas"
+FORMULA_BUNDLE_VERSION = 1
+
+# Pliki danych w katalogu aplikacji (wspólne dla okna i trybu serwera)
+PREPROMPTS_JSON = "preprompts.json"
+PREPROMPTS_DB = "preprompts.db"
+CONVERSATIONS_DIR = "conversations"
+API_KEY_FILE = "api_key.txt"
+CONTEXT_CACHE_FILE = "context_cache.json"
+UPLOADS_FILE = "uploads.json"
+GENERATION_PROFILES_FILE = "generation_profiles.json"
+
+DEFAULT_MODEL_NAME = "gemini-2.5-flash"
+GENERATION_CONFIG = {
+    "temperature": 0.7,
+    "top_p": 0.9,
+    "top_k": 40,
+    "max_output_tokens": 2048 # A more reasonable default for text generation
+}
+SAFETY_SETTINGS = {
+    "HARASSMENT": "BLOCK_NONE",
+    "HATE_SPEECH": "BLOCK_NONE",
+    "SEXUAL": "BLOCK_NONE",
+    "DANGEROUS": "BLOCK_NONE"
+}
+
+# Zmienne w prepromptach: {{nazwa}} lub {{nazwa:argument}}
+# Tylko znane nazwy są zmiennymi - pozostałe klamry (LaTeX, JSON) zostają zwykłym tekstem
+TEMPLATE_PATTERN = re.compile(
+    r'\{\{\s*(language|date|time|clipboard|reply|include)\s*(?::\s*([^{}]*?)\s*)?\}\}'
+)
+DEFAULT_LANGUAGE = "polski"
+
+
+class PrepromptTemplateError(ValueError):
+    """Błąd składni lub odwołania w szablonie prepromptu"""
+
+
+class PrepromptTemplate:
+    """
+    Skompilowany szablon prepromptu.
+    Obsługuje zmienne {{language}}, {{date}}, {{time}}, {{clipboard}},
+    odwołania do poprzednich odpowiedzi {{reply}} / {{reply:2}}
+    oraz składanie prepromptów przez {{include:Nazwa}}.
+    Szablony są kompilowane raz i cache'owane po hashu treści.
+    """
+    _cache = {}
+
+    def __init__(self, parts, includes=()):
+        # parts: lista napisów i krotek (zmienna, argument)
+        self.parts = parts
+        self.includes = tuple(includes)
+        self.is_static = all(isinstance(part, str) for part in parts)
+
+    @staticmethod
+    def content_hash(source):
+        return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def compile(cls, source):
+        """Zwraca skompilowany szablon (z cache, jeśli już był kompilowany)"""
+        key = cls.content_hash(source)
+        template = cls._cache.get(key)
+        if template is None:
+            template = cls(*cls.parse(source))
+            cls._cache[key] = template
+        return template
+
+    @classmethod
+    def parse(cls, source):
+        """Rozbija treść na fragmenty tekstu i zmienne, sprawdzając ich argumenty"""
+        parts = []
+        includes = []
+        pos = 0
+        for match in TEMPLATE_PATTERN.finditer(source):
+            cls._append_text(parts, source[pos:match.start()])
+            name, arg = match.group(1), match.group(2)
+            if name == 'include':
+                if not arg:
+                    raise PrepromptTemplateError("{{include}} wymaga nazwy prepromptu")
+                includes.append(arg)
+            elif name == 'reply':
+                if arg and not (arg.isdigit() and int(arg) > 0):
+                    raise PrepromptTemplateError(
+                        f"Niepoprawny numer odpowiedzi: {{{{reply:{arg}}}}}"
+                    )
+                arg = int(arg) if arg else 1
+            parts.append((name, arg))
+            pos = match.end()
+        cls._append_text(parts, source[pos:])
+        return parts, includes
+
+    @staticmethod
+    def _append_text(parts, text):
+        if not text:
+            return
+        if parts and isinstance(parts[-1], str):
+            parts[-1] += text
+        else:
+            parts.append(text)
+
+    def compose(self, resolve, _stack=()):
+        """
+        Zwraca szablon z rozwiniętymi {{include:...}}.
+        resolve(nazwa) zwraca treść prepromptu lub None, jeśli nie istnieje.
+        """
+        if not self.includes:
+            return self
+        parts = []
+        for part in self.parts:
+            if isinstance(part, str):
+                self._append_text(parts, part)
+                continue
+            if part[0] != 'include':
+                parts.append(part)
+                continue
+            name = part[1]
+            if name in _stack:
+                raise PrepromptTemplateError(
+                    "Cykliczne dołączanie: " + " -> ".join(_stack + (name,))
+                )
+            source = resolve(name)
+            if source is None:
+                raise PrepromptTemplateError(f"Nie ma prepromptu '{name}'")
+            included = self.compile(source).compose(resolve, _stack + (name,))
+            for included_part in included.parts:
+                if isinstance(included_part, str):
+                    self._append_text(parts, included_part)
+                else:
+                    parts.append(included_part)
+        return PrepromptTemplate(parts)
+
+    def render(self, context):
+        """
+        Wypełnia szablon. context mapuje nazwę zmiennej na funkcję
+        przyjmującą argument zmiennej i zwracającą tekst.
+        """
+        if self.is_static:
+            return ''.join(self.parts)
+        out = []
+        for part in self.parts:
+            if isinstance(part, str):
+                out.append(part)
+            else:
+                out.append(str(context[part[0]](part[1])))
+        return ''.join(out)
+
+
+# Wersja indeksu trigramów w bazie (PRAGMA user_version); zmiana wymusza przeindeksowanie
+PREPROMPT_INDEX_VERSION = 1
+# Ile treści prepromptów trzymamy w pamięci po ich wczytaniu
+PREPROMPT_BODY_CACHE_SIZE = 64
+
+
+class PrepromptStore:
+    """
+    Biblioteka prepromptów w bazie SQLite.
+    Zapisy są przyrostowe (jeden wiersz na zmianę), treści wczytywane dopiero
+    przy wyborze, a nazwy i całe treści są zaindeksowane trigramami,
+    co pozwala na szybkie filtrowanie nawet przy tysiącach prepromptów.
+    """
+    def __init__(self, db_path, legacy_json=None):
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS preprompts ("
+            " id INTEGER PRIMARY KEY,"
+            " name TEXT UNIQUE NOT NULL,"
+            " body TEXT NOT NULL,"
+            " trigrams TEXT NOT NULL,"
+            " updated_at TEXT NOT NULL)"
+        )
+        self.conn.commit()
+        # Wielkość liter w SQL zamieniamy Pythonem - lower() SQLite zna tylko ASCII
+        self.conn.create_function("py_lower", 1, str.lower, deterministic=True)
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] < PREPROMPT_INDEX_VERSION:
+            self.reindex()
+        if legacy_json and os.path.exists(legacy_json) and self.is_empty():
+            self.import_json(legacy_json)
+        self.bodies = OrderedDict()
+        self.load_index()
+
+    def data_version(self):
+        return self.conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def refresh_if_changed(self):
+        """
+        Przeładowuje indeks, jeśli bazę zmienił inny proces
+        (np. okno aplikacji i tryb serwera działające jednocześnie).
+        Zwraca True, gdy indeks został przeładowany.
+        """
+        version = self.data_version()
+        if version == self.version:
+            return False
+        self.load_index()
+        return True
+
+    @staticmethod
+    def normalize(text):
+        return ' '.join(text.lower().split())
+
+    @classmethod
+    def trigrams(cls, text):
+        text = cls.normalize(text)
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    @classmethod
+    def index_trigrams(cls, name, body):
+        # Trigramy mają zawsze 3 znaki, więc zapisujemy je sklejone bez separatora
+        return ''.join(sorted(
+            cls.trigrams(name) | cls.trigrams(body)
+        ))
+
+    def reindex(self):
+        """Przelicza trigramy wszystkich prepromptów (starsze bazy indeksowały tylko początek treści)"""
+        rows = self.conn.execute("SELECT id, name, body FROM preprompts").fetchall()
+        with self.conn:
+            self.conn.executemany(
+                "UPDATE preprompts SET trigrams = ? WHERE id = ?",
+                [(self.index_trigrams(name, body), pid) for pid, name, body in rows]
+            )
+            self.conn.execute(f"PRAGMA user_version = {PREPROMPT_INDEX_VERSION}")
+
+    def is_empty(self):
+        return self.conn.execute("SELECT 1 FROM preprompts LIMIT 1").fetchone() is None
+
+    def import_json(self, path):
+        """Importuje preprompty ze starego pliku preprompts.json"""
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        now = datetime.now().isoformat()
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO preprompts(name, body, trigrams, updated_at)"
+                " VALUES (?, ?, ?, ?)",
+                [
+                    (name, body, self.index_trigrams(name, body), now)
+                    for name, body in data.items()
+                ]
+            )
+
+    def load_index(self):
+        """Wczytuje nazwy i indeks trigramów (bez treści prepromptów)"""
+        self.ids = {}
+        self.names_by_id = {}
+        self.postings = {}
+        rows = self.conn.execute("SELECT id, name, trigrams FROM preprompts")
+        for pid, name, trigrams in rows:
+            self._index(pid, name, trigrams)
+        self.sorted_names = sorted(self.ids)
+        self.bodies.clear()
+        self.version = self.data_version()
+
+    def _index(self, pid, name, trigrams):
+        self.ids[name] = pid
+        self.names_by_id[pid] = name
+        for i in range(0, len(trigrams), 3):
+            self.postings.setdefault(trigrams[i:i + 3], []).append(pid)
+
+    def _unindex(self, pid, trigrams):
+        for i in range(0, len(trigrams), 3):
+            posting = self.postings[trigrams[i:i + 3]]
+            posting.remove(pid)
+            if not posting:
+                del self.postings[trigrams[i:i + 3]]
+
+    def __contains__(self, name):
+        return name in self.ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get(self, name, default=None):
+        """Zwraca treść prepromptu, wczytując ją z bazy przy pierwszym użyciu"""
+        body = self.bodies.get(name)
+        if body is not None:
+            self.bodies.move_to_end(name)
+            return body
+        row = self.conn.execute(
+            "SELECT body FROM preprompts WHERE name = ?", (name,)
+        ).fetchone()
+        if row is None:
+            return default
+        self.bodies[name] = row[0]
+        if len(self.bodies) > PREPROMPT_BODY_CACHE_SIZE:
+            self.bodies.popitem(last=False)
+        return row[0]
+
+    def put(self, name, body):
+        """
+        Zapisuje jeden preprompt.
+        Zwraca pozycję nazwy na posortowanej liście, jeśli nazwa jest nowa, inaczej None.
+        """
+        trigrams = self.index_trigrams(name, body)
+        old = self.conn.execute(
+            "SELECT id, trigrams FROM preprompts WHERE name = ?", (name,)
+        ).fetchone()
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO preprompts(name, body, trigrams, updated_at)"
+                " VALUES (?, ?, ?, ?)"
+                " ON CONFLICT(name) DO UPDATE SET"
+                " body = excluded.body,"
+                " trigrams = excluded.trigrams,"
+                " updated_at = excluded.updated_at",
+                (name, body, trigrams, datetime.now().isoformat())
+            )
+        self.bodies.pop(name, None)
+        if old is not None:
+            self._unindex(old[0], old[1])
+            self._index(old[0], name, trigrams)
+            return None
+        pid = self.conn.execute(
+            "SELECT id FROM preprompts WHERE name = ?", (name,)
+        ).fetchone()[0]
+        self._index(pid, name, trigrams)
+        position = bisect.bisect_left(self.sorted_names, name)
+        self.sorted_names.insert(position, name)
+        return position
+
+    def delete(self, name):
+        """Usuwa preprompt, zwraca jego dawną pozycję na posortowanej liście"""
+        row = self.conn.execute(
+            "SELECT id, trigrams FROM preprompts WHERE name = ?", (name,)
+        ).fetchone()
+        if row is None:
+            return None
+        with self.conn:
+            self.conn.execute("DELETE FROM preprompts WHERE id = ?", (row[0],))
+        self._unindex(row[0], row[1])
+        del self.ids[name]
+        del self.names_by_id[row[0]]
+        self.bodies.pop(name, None)
+        position = bisect.bisect_left(self.sorted_names, name)
+        del self.sorted_names[position]
+        return position
+
+    def search(self, query, limit=None):
+        """
+        Filtr rozmyty po nazwach i treściach.
+        Wyniki są sortowane po liczbie wspólnych trigramów,
+        trafienia w nazwie mają pierwszeństwo. Zapytania krótsze niż trigram
+        szukamy jako podciągu nazwy lub treści.
+        Pusty filtr zwraca wszystkie nazwy (lista okna musi odpowiadać
+        pozycjom zwracanym przez put/delete); limit=None oznacza bez limitu.
+        """
+        query = self.normalize(query)
+        if not query:
+            return self.sorted_names[:limit]
+        if len(query) < 3:
+            in_body = {
+                name for (name,) in self.conn.execute(
+                    "SELECT name FROM preprompts WHERE instr(py_lower(body), ?)", (query,)
+                )
+            }
+            return sorted(
+                (name for name in self.sorted_names if query in name.lower() or name in in_body),
+                key=lambda name: query not in name.lower()
+            )[:limit]
+
+        query_trigrams = self.trigrams(query)
+        scores = {}
+        for trigram in query_trigrams:
+            for pid in self.postings.get(trigram, ()):
+                scores[pid] = scores.get(pid, 0) + 1
+
+        # Wymagamy większości trigramów zapytania, żeby odsiać przypadkowe trafienia
+        threshold = max(1, (len(query_trigrams) * 2 + 2) // 3)
+        results = []
+        for pid, score in scores.items():
+            if score >= threshold:
+                name = self.names_by_id[pid]
+                in_name = query in name.lower()
+                results.append((-in_name, -score, name))
+        results.sort()
+        return [name for _, _, name in results[:limit]]
+
+
+# Preprompty krótsze niż to (w przybliżeniu tokenów) wysyłamy zawsze w całości,
+# API nie pozwala cache'ować zbyt małych treści
+CONTEXT_CACHE_MIN_TOKENS = 1024
+CONTEXT_CACHE_TTL = timedelta(hours=1)
+# Na tyle przed wygaśnięciem przedłużamy TTL cache'u
+CONTEXT_CACHE_REFRESH_MARGIN = timedelta(minutes=5)
+
+
+# Adres alternatywnego serwera API (np. lokalnej zaślepki do pomiarów opóźnień)
+GEMINI_ENDPOINT_ENV = "GEMINI_API_ENDPOINT"
+# Ustawienie tej zmiennej wyłącza rozgrzewanie połączenia (pomiar "zimnego" startu)
+GEMINI_NO_WARMUP_ENV = "GEMINI_NO_WARMUP"
+
+
+class GeminiClient:
+    """
+    Długo żyjące połączenie z Gemini API.
+    Wszystkie modele korzystają z jednego klienta biblioteki (jednej puli połączeń),
+    połączenie można rozgrzać w tle, a zmiana klucza podmienia konfigurację
+    bez przerywania trwających zapytań.
+    """
+    def __init__(self, api_key):
+        self.lock = Lock()
+        self.models = {}
+        self.warm_up_time = None
+        self.first_request_time = None
+        self.configure(api_key)
+
+    def configure(self, api_key):
+        """Ustawia klucz API; kolejne zapytania użyją nowego klienta"""
+        options = {}
+        endpoint = os.environ.get(GEMINI_ENDPOINT_ENV)
+        if endpoint:
+            options = {
+                "transport": "rest",
+                "client_options": {"api_endpoint": endpoint}
+            }
+        with self.lock:
+            genai.configure(api_key=api_key, **options)
+            # Trwające zapytania trzymają własne obiekty modeli (i ich klienta),
+            # więc wystarczy zapomnieć stare modele
+            self.models = {}
+            self.warm_up_time = None
+
+    def model(self, model_name=DEFAULT_MODEL_NAME):
+        """Zwraca (współdzielony) obiekt modelu o podanej nazwie"""
+        with self.lock:
+            model = self.models.get(model_name)
+            if model is None:
+                model = genai.GenerativeModel(model_name)
+                self.models[model_name] = model
+            return model
+
+    def warm_up(self, model_name=DEFAULT_MODEL_NAME):
+        """
+        Nawiązuje połączenie (DNS, TLS, kanał) tanim zapytaniem count_tokens,
+        żeby pierwsza wiadomość nie płaciła za jego zestawienie.
+        Zwraca czas rozgrzewania w sekundach lub None w razie błędu.
+        """
+        start = time.perf_counter()
+        try:
+            self.model(model_name).count_tokens("ping")
+        except Exception as e:
+            print(f"Connection warm-up failed: {e}")
+            return None
+        self.warm_up_time = time.perf_counter() - start
+        return self.warm_up_time
+
+    def record_request(self, elapsed):
+        """Zapamiętuje czas pierwszego zapytania (do porównania zimnego i ciepłego startu)"""
+        if self.first_request_time is not None:
+            return
+        self.first_request_time = elapsed
+        state = "warm" if self.warm_up_time is not None else "cold"
+        print(f"First request latency: {elapsed:.3f} s ({state} connection)")
+
+
+def generate_reply(client, context_cache, preprompt, user_text,
+                   model_name=DEFAULT_MODEL_NAME, stream=False, attachments=(),
+                   generation_config=GENERATION_CONFIG, cacheable=True):
+    """
+    Wysyła zapytanie, korzystając z cache'u kontekstu dla długich prepromptów.
+    attachments to uchwyty plików z File API, wysyłane jako osobne części zapytania.
+    cacheable=False dla prepromptów ze zmiennymi ({{time}}, {{clipboard}}, ...),
+    których treść zmienia się między zapytaniami - cache'owanie ich nie ma sensu.
+    Zwraca (odpowiedź, czy_użyto_cache).
+    """
+    model = client.model(model_name)
+    cached_model = context_cache.model_for(model.model_name, preprompt) if cacheable else None
+    if cached_model is not None:
+        try:
+            return cached_model.generate_content(
+                contents=[user_text, *attachments] if attachments else user_text,
+                generation_config=generation_config,
+                safety_settings=SAFETY_SETTINGS,
+                stream=stream
+            ), True
+        except Exception as e:
+            # Cache mógł wygasnąć po stronie serwera - wysyłamy całość
+            print(f"Cached request failed, retrying without cache: {e}")
+            context_cache.invalidate(model.model_name, preprompt)
+
+    return model.generate_content(
+        contents=(
+            # API odrzuca puste części tekstowe - pusty preprompt pomijamy
+            ([preprompt] if preprompt else []) + [user_text, *attachments] if attachments
+            else preprompt + " " + user_text
+        ),
+        generation_config=generation_config,
+        safety_settings=SAFETY_SETTINGS,
+        stream=stream
+    ), False
+
+
+def write_json_atomic(path, data, compact=False):
+    """
+    Zapisuje JSON przez plik tymczasowy i os.replace, żeby inny proces
+    (np. tryb serwera i okno aplikacji jednocześnie) nigdy nie odczytał połowy pliku.
+    Nazwa pliku tymczasowego zawiera proces i wątek, więc równoległe zapisy
+    tej samej ścieżki nie piszą do jednego pliku - wygrywa ostatni os.replace.
+    compact=True pomija wcięcia (konwersacje, w których liczy się rozmiar).
+    """
+    tmp_path = f"{path}.{os.getpid()}.{get_ident()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        if compact:
+            json.dump(data, f, separators=(',', ':'), ensure_ascii=False)
+        else:
+            json.dump(data, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+# === Załączniki (File API) ===
+UPLOAD_HASH_CHUNK = 1024 * 1024
+# Pliki w File API wygasają po 48 h - starsze wpisy przesyłamy ponownie
+UPLOAD_TTL = timedelta(hours=47)
+UPLOAD_POLL_INTERVAL = 1.0
+# Wielkość jednej części przesyłania wznawialnego (wielokrotność 256 KB)
+UPLOAD_CHUNK = 8 * 1024 * 1024
+# Typy plików przyjmowane przez File API (przedrostki typów MIME)
+ATTACHMENT_MIME_TYPES = ("text/", "image/", "audio/", "video/", "application/pdf", "application/json")
+ATTACHMENT_FILETYPES = [
+    ("Tekst, PDF i obrazy", "*.txt *.md *.csv *.json *.py *.html *.pdf *.png *.jpg *.jpeg *.webp"),
+    ("Wszystkie pliki", "*.*"),
+]
+
+
+def file_sha256(path, progress=None):
+    """Skrót SHA-256 pliku liczony strumieniowo, bez wczytywania całego pliku do pamięci"""
+    digest = hashlib.sha256()
+    size = os.path.getsize(path)
+    done = 0
+    with open(path, 'rb') as f:
+        while chunk := f.read(UPLOAD_HASH_CHUNK):
+            digest.update(chunk)
+            done += len(chunk)
+            if progress is not None:
+                progress(done, size)
+    return digest.hexdigest()
+
+
+def attachment_mime_type(path):
+    """Typ MIME załącznika albo None, gdy File API go nie przyjmie lub typu nie da się rozpoznać"""
+    mime_type = mimetypes.guess_type(path)[0]
+    if mime_type is None or not mime_type.startswith(ATTACHMENT_MIME_TYPES):
+        return None
+    return mime_type
+
+
+def upload_file_chunked(path, mime_type, display_name, progress):
+    """
+    Przesyła plik protokołem wznawialnym po UPLOAD_CHUNK bajtów, zgłaszając
+    progress(przesłane_bajty, rozmiar) po każdej części. Korzysta z klienta File API
+    biblioteki (tego samego co genai.upload_file); gdy jego budowa jest inna niż
+    oczekiwana, plik idzie w całości przez genai.upload_file.
+    """
+    size = os.path.getsize(path)
+    try:
+        import googleapiclient.http
+        from google.generativeai.client import get_default_file_client
+        client = get_default_file_client()
+        client._setup_discovery_api()
+        api = client._local.discovery_api
+    except (ImportError, AttributeError) as e:
+        print(f"Chunked upload unavailable, uploading in one request: {e}")
+        progress(0, size)
+        return genai.upload_file(path=path, mime_type=mime_type, display_name=display_name)
+
+    media = googleapiclient.http.MediaFileUpload(
+        path, mimetype=mime_type, chunksize=UPLOAD_CHUNK, resumable=True
+    )
+    request = api.media().upload(body={"file": {"displayName": display_name}}, media_body=media)
+    response = None
+    while response is None:
+        status, response = request.next_chunk()
+        if status is not None:
+            progress(status.resumable_progress, size)
+    progress(size, size)
+    return genai.get_file(response["file"]["name"])
+
+
+class FileUploads:
+    """
+    Pliki przesłane przez File API, zapamiętane według skrótu treści (uploads.json),
+    więc ten sam plik nie jest przesyłany drugi raz - również pod inną nazwą
+    i po ponownym uruchomieniu aplikacji. Uchwyty są trzymane w pamięci
+    i używane ponownie w kolejnych wiadomościach.
+    Każdy plik (skrót) ma własną blokadę, więc przesyłanie i oczekiwanie
+    na przetworzenie jednego pliku nie wstrzymuje innych kart.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock() # Chroni słowniki i zapis uploads.json
+        self.file_locks = {} # sha256 -> blokada przesyłania tego pliku
+        self.handles = {} # sha256 -> uchwyt pliku z API
+        self.digests = {} # (ścieżka, rozmiar, czas modyfikacji) -> sha256
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def digest(self, path, progress):
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        if key not in self.digests:
+            name = os.path.basename(path)
+            self.digests[key] = file_sha256(
+                path,
+                lambda done, size: progress(f"Liczenie skrótu {name}: {done * 100 // max(size, 1)}%")
+            )
+        return self.digests[key]
+
+    def fresh(self, digest):
+        entry = self.entries.get(digest)
+        return (entry is not None
+                and datetime.fromisoformat(entry["uploaded_at"]) + UPLOAD_TTL > datetime.now())
+
+    def handle(self, path, progress):
+        """Zwraca uchwyt pliku, przesyłając go tylko wtedy, gdy API jeszcze go nie ma"""
+        name = os.path.basename(path)
+        mime_type = attachment_mime_type(path)
+        if mime_type is None:
+            raise ValueError(f"Nieobsługiwany typ pliku: {name}")
+        digest = self.digest(path, progress)
+        with self.lock:
+            file_lock = self.file_locks.setdefault(digest, Lock())
+        with file_lock:
+            with self.lock:
+                fresh = self.fresh(digest)
+                handle = self.handles.get(digest) if fresh else None
+                remote_name = self.entries[digest]["name"] if fresh else None
+            if handle is None and remote_name is not None:
+                try:
+                    handle = genai.get_file(remote_name)
+                except Exception as e:
+                    print(f"Uploaded file is no longer available, uploading again: {e}")
+            if handle is None:
+                handle = upload_file_chunked(
+                    path, mime_type, name,
+                    lambda done, size: progress(
+                        f"Przesyłanie {name} ({size / 1e6:.1f} MB): {done * 100 // max(size, 1)}%"
+                    )
+                )
+                with self.lock:
+                    self.entries[digest] = {
+                        "name": handle.name,
+                        "file": name,
+                        "mime_type": mime_type,
+                        "uploaded_at": datetime.now().isoformat(),
+                    }
+                    write_json_atomic(self.path, self.entries)
+            while handle.state.name == "PROCESSING":
+                progress(f"Przetwarzanie {name} po stronie API...")
+                time.sleep(UPLOAD_POLL_INTERVAL)
+                handle = genai.get_file(handle.name)
+            with self.lock:
+                if handle.state.name == "FAILED":
+                    self.entries.pop(digest, None)
+                    write_json_atomic(self.path, self.entries)
+                    raise ValueError(f"API nie przyjęło pliku {name}")
+                self.handles[digest] = handle
+            return handle
+
+    def prepare(self, paths, progress):
+        """Uchwyty dla listy plików; progress(tekst) dostaje postęp"""
+        handles = []
+        for number, path in enumerate(paths, 1):
+            handles.append(self.handle(path, lambda text: progress(f"[{number}/{len(paths)}] {text}")))
+        return handles
+
+
+# Wersja formatu plików konwersacji (1: lista [rola, tekst] z prepromptem w każdej wiadomości)
+CONVERSATION_FORMAT_VERSION = 2
+
+
+class Role(enum.Enum):
+    USER = "user"
+    BOT = "bot"
+    ERROR = "error"
+
+
+class Message:
+    """
+    Zwarty rekord jednej wiadomości.
+    Preprompt nie jest doklejany do tekstu - wiadomość wskazuje go identyfikatorem,
+    a jego treść (dla szablonów - źródło przed podstawieniem zmiennych)
+    jest przechowywana raz na konwersację.
+    Iteracja daje (rola, tekst), więc rekord można rozpakować jak dawną krotkę.
+    """
+    __slots__ = ('role', 'text', 'preprompt_id', 'timestamp', 'tokens', 'attachments')
+
+    def __init__(self, role, text, preprompt_id=None, timestamp=None, tokens=None,
+                 attachments=None):
+        self.role = role
+        self.text = text
+        self.preprompt_id = preprompt_id
+        self.timestamp = int(time.time()) if timestamp is None else timestamp
+        self.tokens = tokens
+        self.attachments = attachments # Nazwy załączonych plików
+
+    def __iter__(self):
+        yield self.role.value
+        yield self.text
+
+    def to_dict(self):
+        data = {"role": self.role.value, "text": self.text}
+        if self.timestamp:
+            data["ts"] = self.timestamp
+        if self.preprompt_id is not None:
+            data["preprompt"] = self.preprompt_id
+        if self.tokens is not None:
+            data["tokens"] = self.tokens
+        if self.attachments:
+            data["files"] = self.attachments
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            Role(data["role"]),
+            data["text"],
+            data.get("preprompt"),
+            data.get("ts", 0),
+            data.get("tokens"),
+            data.get("files")
+        )
+
+
+def preprompt_id(text):
+    """Identyfikator prepromptu w obrębie konwersacji (skrót treści)"""
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:12]
+
+
+def load_conversation_data(data):
+    """
+    Zwraca (wiadomości, preprompty) z danych pliku konwersacji.
+    Pliki w starym formacie są migrowane: z wiadomości użytkownika odcinany jest
+    doklejony na początku prompt systemowy i zapisywany raz, jako preprompt konwersacji.
+    """
+    if data.get("version", 1) >= 2:
+        messages = [Message.from_dict(entry) for entry in data.get("messages", [])]
+        return messages, dict(data.get("preprompts", {}))
+
+    system_prompt = data.get("system_prompt", "").strip()
+    prefix = system_prompt + " "
+    preprompts = {}
+    messages = []
+    for role, text in data.get("history", []):
+        pid = None
+        if role == "user" and system_prompt and text.startswith(prefix):
+            text = text[len(prefix):]
+            pid = preprompt_id(system_prompt)
+            preprompts[pid] = system_prompt
+        try:
+            role = Role(role)
+        except ValueError:
+            role = Role.BOT
+        messages.append(Message(role, text, pid, 0))
+    return messages, preprompts
+
+
+def conversation_to_data(messages, preprompts, system_prompt, created_at=None):
+    """Buduje dane pliku konwersacji (tylko z prepromptami, do których są odwołania)"""
+    used = {m.preprompt_id for m in messages if m.preprompt_id is not None}
+    return {
+        "version": CONVERSATION_FORMAT_VERSION,
+        "system_prompt": system_prompt,
+        "created_at": created_at or datetime.now().isoformat(),
+        "preprompts": {pid: text for pid, text in preprompts.items() if pid in used},
+        "messages": [m.to_dict() for m in messages],
+    }
+
+
+def migrate_conversations(conversations_dir):
+    """
+    Przepisuje wszystkie konwersacje do bieżącego formatu i wypisuje
+    rozmiar plików oraz zajętość pamięci przed i po migracji.
+    """
+    size_before = size_after = 0
+    memory_before = memory_after = 0
+    migrated = 0
+    for filename in sorted(os.listdir(conversations_dir)):
+        if not filename.endswith('.json'):
+            continue
+        path = os.path.join(conversations_dir, filename)
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get("version", 1) >= CONVERSATION_FORMAT_VERSION:
+            continue
+
+        size_before += os.path.getsize(path)
+        tracemalloc.start()
+        old_history = [tuple(entry) for entry in json.loads(json.dumps(data.get("history", [])))]
+        memory_before += tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del old_history
+
+        tracemalloc.start()
+        messages, preprompts = load_conversation_data(data)
+        memory_after += tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        write_json_atomic(path, conversation_to_data(
+            messages, preprompts, data.get("system_prompt", ""), data.get("created_at")
+        ), compact=True)
+        size_after += os.path.getsize(path)
+        migrated += 1
+
+    print(f"Zmigrowano konwersacji: {migrated}")
+    if migrated:
+        print(f"Rozmiar plików: {size_before / 1024:.1f} KB -> {size_after / 1024:.1f} KB")
+        print(f"Pamięć historii: {memory_before / 1024:.1f} KB -> {memory_after / 1024:.1f} KB")
+
+
+class GeminiCacheBackend:
+    """Backend ContextCache korzystający z Gemini context caching API"""
+    def __init__(self):
+        from google.generativeai import caching
+        self.caching = caching
+        self.models = {}
+
+    def create(self, model_name, content, ttl):
+        cached = self.caching.CachedContent.create(
+            model=model_name,
+            contents=[content],
+            ttl=ttl
+        )
+        return cached.name, cached.expire_time
+
+    def refresh(self, name, ttl):
+        cached = self.caching.CachedContent.get(name)
+        cached.update(ttl=ttl)
+        return cached.expire_time
+
+    def model(self, name):
+        model = self.models.get(name)
+        if model is None:
+            model = genai.GenerativeModel.from_cached_content(
+                cached_content=self.caching.CachedContent.get(name)
+            )
+            self.models[name] = model
+        return model
+
+    def delete(self, name):
+        self.models.pop(name, None)
+        self.caching.CachedContent.get(name).delete()
+
+
+class ContextCache:
+    """
+    Cache kontekstu dla długich prepromptów.
+    Preprompt jest wysyłany raz i później wskazywany nazwą cache'u.
+    Mapowanie hash prepromptu -> uchwyt cache'u jest trzymane w pliku JSON,
+    TTL jest przedłużany przed wygaśnięciem, a każdy błąd API
+    kończy się po prostu wysłaniem prepromptu w całości.
+    """
+    def __init__(self, path, backend_factory=GeminiCacheBackend):
+        self.path = path
+        self.lock = Lock()
+        self.failed = set()
+        try:
+            self.backend = backend_factory()
+        except Exception as e:
+            print(f"Context caching unavailable: {e}")
+            self.backend = None
+        self.entries = {}
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    self.entries = json.load(f)
+        except Exception as e:
+            print(f"Error loading context cache index: {e}")
+
+    @staticmethod
+    def key(model_name, preprompt):
+        return hashlib.sha256(f"{model_name}\0{preprompt}".encode('utf-8')).hexdigest()
+
+    def save(self):
+        # Wygasłe wpisy nie są już nic warte - nie trzymamy ich w pliku
+        now = datetime.now(timezone.utc)
+        for key, entry in list(self.entries.items()):
+            try:
+                expired = datetime.fromisoformat(entry["expire_time"]) <= now
+            except (KeyError, TypeError, ValueError):
+                expired = True
+            if expired:
+                del self.entries[key]
+        try:
+            write_json_atomic(self.path, self.entries)
+        except Exception as e:
+            print(f"Error saving context cache index: {e}")
+
+    def model_for(self, model_name, preprompt):
+        """
+        Zwraca model powiązany z cache'em zawierającym preprompt
+        albo None, jeśli preprompt trzeba wysłać w całości.
+        """
+        if self.backend is None or len(preprompt) // 4 < CONTEXT_CACHE_MIN_TOKENS:
+            return None
+        key = self.key(model_name, preprompt)
+        if key in self.failed:
+            return None
+
+        with self.lock:
+            now = datetime.now(timezone.utc)
+            entry = self.entries.get(key)
+            try:
+                if entry is not None:
+                    expire_time = datetime.fromisoformat(entry["expire_time"])
+                    if expire_time <= now:
+                        entry = None
+                    elif expire_time - now < CONTEXT_CACHE_REFRESH_MARGIN:
+                        expire_time = self.backend.refresh(entry["name"], CONTEXT_CACHE_TTL)
+                        entry["expire_time"] = expire_time.isoformat()
+                        self.save()
+                if entry is None:
+                    name, expire_time = self.backend.create(
+                        model_name, preprompt, CONTEXT_CACHE_TTL
+                    )
+                    entry = {
+                        "name": name,
+                        "model": model_name,
+                        "expire_time": expire_time.isoformat()
+                    }
+                    self.entries[key] = entry
+                    self.save()
+                return self.backend.model(entry["name"])
+            except Exception as e:
+                print(f"Context cache error, sending full preprompt: {e}")
+                self.entries.pop(key, None)
+                self.failed.add(key)
+                self.save()
+                return None
+
+    def invalidate(self, model_name, preprompt):
+        """Zapomina cache prepromptu (np. gdy API go już nie zna)"""
+        with self.lock:
+            if self.entries.pop(self.key(model_name, preprompt), None) is not None:
+                self.save()
+
+    def clear(self):
+        """Usuwa wszystkie wpisy, np. po zmianie klucza API"""
+        with self.lock:
+            entries, self.entries = self.entries, {}
+            self.failed.clear()
+            self.save()
+        if self.backend is None:
+            return
+        for entry in entries.values():
+            try:
+                self.backend.delete(entry["name"])
+            except Exception as e:
+                print(f"Error deleting cached content: {e}")
+
+
+# === Profile generowania ===
+# Domyślny cel: odpowiedź gotowa w tym czasie (sekundy)
+GENERATION_LATENCY_TARGET = 30.0
+# Ile ostatnich pomiarów pamiętamy na profil
+GENERATION_SAMPLES = 50
+# Tryb adaptacyjny zmienia limit dopiero po tylu pomiarach
+ADAPTIVE_MIN_SAMPLES = 5
+ADAPTIVE_MIN_TOKENS = 256
+ADAPTIVE_MAX_TOKENS = 8192
+# Zapas ponad p95 długości odpowiedzi; po obcięciu limit rośnie o ten czynnik
+ADAPTIVE_HEADROOM = 1.5
+
+
+def percentile(values, fraction):
+    """Percentyl (metoda najbliższego rzędu) z niepustej listy"""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class GenerationProfiles:
+    """
+    Ustawienia generowania osobno dla każdego prepromptu (rozpoznawanego po treści)
+    wraz z pomiarami ostatnich odpowiedzi: czas, liczba tokenów i czy odpowiedź
+    została obcięta (finish_reason MAX_TOKENS).
+    W trybie adaptacyjnym max_output_tokens jest dobierany z pomiarów: z zapasem
+    ponad p95 długości odpowiedzi, większy po obcięciach, ale nie większy niż
+    liczba tokenów, którą model zdąży wygenerować w docelowym czasie.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = {}
+        self.latency_target = data.get("latency_target", GENERATION_LATENCY_TARGET)
+        self.profiles = data.get("profiles", {})
+
+    def save(self):
+        with self.lock:
+            data = {"latency_target": self.latency_target, "profiles": self.profiles}
+            write_json_atomic(self.path, data)
+
+    def profile(self, source):
+        """Profil prepromptu o podanej treści (tworzony przy pierwszym użyciu)"""
+        key = preprompt_id(source)
+        with self.lock:
+            if key not in self.profiles:
+                self.profiles[key] = {
+                    "label": " ".join(source.split())[:60] or "(bez prepromptu)",
+                    "config": dict(GENERATION_CONFIG),
+                    "adaptive": False,
+                    "samples": [],
+                }
+            return key, self.profiles[key]
+
+    def config_for(self, source):
+        """generation_config do wysłania z tym prepromptem"""
+        key, profile = self.profile(source)
+        config = dict(profile["config"])
+        if profile["adaptive"]:
+            config["max_output_tokens"] = self.tuned_max_tokens(profile)
+        return key, config
+
+    def record(self, key, latency, output_tokens, truncated):
+        with self.lock:
+            samples = self.profiles[key]["samples"]
+            samples.append([round(latency, 3), output_tokens, truncated])
+            del samples[:-GENERATION_SAMPLES]
+        self.save()
+
+    def tuned_max_tokens(self, profile):
+        limit = profile["config"]["max_output_tokens"]
+        samples = [s for s in profile["samples"] if s[1]]
+        if len(samples) < ADAPTIVE_MIN_SAMPLES:
+            return limit
+        needed = percentile([tokens for _, tokens, _ in samples], 0.95) * ADAPTIVE_HEADROOM
+        if any(truncated for _, _, truncated in samples[-10:]):
+            needed = max(needed, limit * ADAPTIVE_HEADROOM)
+        # Tokeny na sekundę (mediana), żeby przewidzieć czas dłuższej odpowiedzi
+        rates = [tokens / latency for latency, tokens, _ in samples if latency > 0]
+        if not rates:
+            return limit
+        within_target = percentile(rates, 0.5) * self.latency_target
+        return int(max(ADAPTIVE_MIN_TOKENS, min(needed, within_target, ADAPTIVE_MAX_TOKENS)))
+
+    def stats(self, profile):
+        """(p95 czasu w s lub None, odsetek obciętych odpowiedzi, liczba pomiarów)"""
+        samples = profile["samples"]
+        if not samples:
+            return None, 0.0, 0
+        p95 = percentile([latency for latency, _, _ in samples], 0.95)
+        truncated = sum(1 for _, _, t in samples if t) / len(samples)
+        return p95, truncated, len(samples)
+
+
+class GenerationProfilesWindow:
+    """Podgląd i edycja profili generowania wraz z nauczonymi ustawieniami i zmierzonym p95"""
+    COLUMNS = (
+        ("label", "Preprompt", 260),
+        ("temperature", "Temp.", 60),
+        ("top_p", "top_p", 60),
+        ("top_k", "top_k", 60),
+        ("max_tokens", "Limit tokenów", 100),
+        ("adaptive", "Adaptacyjny", 90),
+        ("samples", "Pomiary", 70),
+        ("p95", "p95 [s]", 70),
+        ("truncated", "Obcięte", 70),
+    )
+
+    def __init__(self, app):
+        self.app = app
+        self.profiles = app.generation_profiles
+
+        self.window = tk.Toplevel(app.root)
+        self.window.title("Profile generowania")
+        self.window.geometry("950x450")
+
+        top = ttk.Frame(self.window)
+        top.pack(fill=tk.X, padx=10, pady=10)
+        ttk.Label(top, text="Docelowy czas odpowiedzi [s]:").pack(side=tk.LEFT)
+        self.target_var = tk.StringVar(value=str(self.profiles.latency_target))
+        ttk.Entry(top, textvariable=self.target_var, width=8).pack(side=tk.LEFT, padx=5)
+
+        self.tree = ttk.Treeview(
+            self.window,
+            columns=[name for name, _, _ in self.COLUMNS],
+            show='headings',
+            selectmode='browse'
+        )
+        for name, heading, width in self.COLUMNS:
+            self.tree.heading(name, text=heading)
+            self.tree.column(name, width=width, anchor=tk.W if name == "label" else tk.E)
+        self.tree.pack(fill=tk.BOTH, expand=True, padx=10)
+        self.tree.bind("<<TreeviewSelect>>", self.on_select)
+
+        # Edycja zaznaczonego profilu
+        editor = ttk.Frame(self.window)
+        editor.pack(fill=tk.X, padx=10, pady=10)
+        self.vars = {}
+        for name, label in (("temperature", "Temperatura"), ("top_p", "top_p"),
+                            ("top_k", "top_k"), ("max_output_tokens", "max_output_tokens")):
+            ttk.Label(editor, text=f"{label}:").pack(side=tk.LEFT)
+            self.vars[name] = tk.StringVar()
+            ttk.Entry(editor, textvariable=self.vars[name], width=8).pack(side=tk.LEFT, padx=(2, 8))
+        self.adaptive_var = tk.BooleanVar()
+        ttk.Checkbutton(editor, text="Adaptacyjny", variable=self.adaptive_var).pack(side=tk.LEFT)
+        ttk.Button(editor, text="Zapisz", command=self.apply).pack(side=tk.RIGHT)
+        ttk.Button(editor, text="Wyczyść pomiary", command=self.clear_samples).pack(side=tk.RIGHT, padx=5)
+
+        self.refresh()
+
+    def refresh(self):
+        selected = self.tree.selection()
+        self.tree.delete(*self.tree.get_children())
+        for key, profile in self.profiles.profiles.items():
+            config = profile["config"]
+            p95, truncated, count = self.profiles.stats(profile)
+            max_tokens = config["max_output_tokens"]
+            if profile["adaptive"]:
+                max_tokens = f"{self.profiles.tuned_max_tokens(profile)} (z {max_tokens})"
+            self.tree.insert('', tk.END, iid=key, values=(
+                profile["label"],
+                config["temperature"],
+                config["top_p"],
+                config["top_k"],
+                max_tokens,
+                "tak" if profile["adaptive"] else "nie",
+                count,
+                f"{p95:.2f}" if p95 is not None else "-",
+                f"{truncated:.0%}",
+            ))
+        if selected and self.tree.exists(selected[0]):
+            self.tree.selection_set(selected[0])
+
+    def selected_profile(self):
+        selection = self.tree.selection()
+        return self.profiles.profiles.get(selection[0]) if selection else None
+
+    def on_select(self, event):
+        profile = self.selected_profile()
+        if profile is None:
+            return
+        for name, var in self.vars.items():
+            var.set(str(profile["config"][name]))
+        self.adaptive_var.set(profile["adaptive"])
+
+    def apply(self):
+        try:
+            target = float(self.target_var.get())
+            profile = self.selected_profile()
+            config = None
+            if profile is not None:
+                config = {
+                    "temperature": float(self.vars["temperature"].get()),
+                    "top_p": float(self.vars["top_p"].get()),
+                    "top_k": int(self.vars["top_k"].get()),
+                    "max_output_tokens": int(self.vars["max_output_tokens"].get()),
+                }
+        except ValueError:
+            messagebox.showwarning(
+                "Błędne ustawienia",
+                "Podaj liczby w polach ustawień.",
+                parent=self.window
+            )
+            return
+        with self.profiles.lock:
+            self.profiles.latency_target = target
+            if profile is not None:
+                profile["config"] = config
+                profile["adaptive"] = self.adaptive_var.get()
+        self.profiles.save()
+        self.refresh()
+
+    def clear_samples(self):
+        profile = self.selected_profile()
+        if profile is None:
+            return
+        with self.profiles.lock:
+            profile["samples"] = []
+        self.profiles.save()
+        self.refresh()
+
+
+class CompareVariant:
+    """Jeden wariant porównania: model i jego ustawienia generowania"""
+    def __init__(self, model_name, temperature, max_output_tokens):
+        self.model_name = model_name
+        self.temperature = temperature
+        self.max_output_tokens = max_output_tokens
+
+    @classmethod
+    def parse(cls, line):
+        """Parsuje linię 'model [temperatura] [max_tokenów]'"""
+        fields = line.split()
+        if not fields or len(fields) > 3:
+            raise ValueError(f"Niepoprawny wariant: '{line}'")
+        temperature = float(fields[1]) if len(fields) > 1 else GENERATION_CONFIG["temperature"]
+        max_tokens = int(fields[2]) if len(fields) > 2 else GENERATION_CONFIG["max_output_tokens"]
+        return cls(fields[0], temperature, max_tokens)
+
+    def __str__(self):
+        return f"{self.model_name} {self.temperature:g} {self.max_output_tokens}"
+
+    def generation_config(self):
+        return dict(
+            GENERATION_CONFIG,
+            temperature=self.temperature,
+            max_output_tokens=self.max_output_tokens
+        )
+
+
+class CompareWindow:
+    """
+    Okno porównania: ta sama wiadomość trafia równolegle do kilku wariantów,
+    a ich strumienie są wyświetlane obok siebie razem z czasem odpowiedzi,
+    liczbą tokenów i szybkością generowania.
+    """
+    DEFAULT_VARIANTS = (
+        f"{DEFAULT_MODEL_NAME} 0.7 2048",
+        f"{DEFAULT_MODEL_NAME} 0.2 2048",
+    )
+
+    def __init__(self, app, message):
+        self.app = app
+        self.message = message
+        self.events = queue.Queue()
+        self.columns = []
+
+        self.window = tk.Toplevel(app.root)
+        self.window.title("Porównanie modeli")
+        self.window.geometry("1100x650")
+
+        top = ttk.Frame(self.window)
+        top.pack(fill=tk.X, padx=10, pady=10)
+        ttk.Label(
+            top,
+            text="Warianty (model temperatura max_tokenów, jeden na linię):"
+        ).pack(anchor=tk.W)
+        self.variants_text = tk.Text(top, height=4, font=('Arial', 10))
+        self.variants_text.pack(fill=tk.X)
+        self.variants_text.insert(tk.END, "\n".join(self.load_variants()))
+        self.send_button = ttk.Button(
+            top,
+            text="Wyślij do wszystkich",
+            command=self.start
+        )
+        self.send_button.pack(side=tk.LEFT, pady=(5, 0))
+        self.summary_var = tk.StringVar()
+        ttk.Label(top, textvariable=self.summary_var).pack(side=tk.LEFT, padx=10)
+
+        self.results_frame = ttk.Frame(self.window)
+        self.results_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=(0, 10))
+
+    def load_variants(self):
+        try:
+            with open(self.app.compare_variants_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return list(self.DEFAULT_VARIANTS)
+
+    def save_variants(self, variants):
+        try:
+            with open(self.app.compare_variants_file, 'w', encoding='utf-8') as f:
+                json.dump([str(v) for v in variants], f, indent=2)
+        except OSError as e:
+            print(f"Error saving compare variants: {e}")
+
+    def start(self):
+        lines = self.variants_text.get("1.0", tk.END).splitlines()
+        try:
+            variants = [CompareVariant.parse(line) for line in lines if line.strip()]
+        except ValueError as e:
+            messagebox.showwarning("Błędne warianty", str(e), parent=self.window)
+            return
+        if not variants:
+            return
+        self.save_variants(variants)
+
+        for child in self.results_frame.winfo_children():
+            child.destroy()
+        self.columns = []
+        for index, variant in enumerate(variants):
+            self.results_frame.columnconfigure(index, weight=1, uniform="variant")
+            frame = ttk.LabelFrame(self.results_frame, text=str(variant), padding=5)
+            frame.grid(row=0, column=index, sticky="nsew", padx=2)
+            display = scrolledtext.ScrolledText(
+                frame,
+                wrap=tk.WORD,
+                font=('Arial', 10),
+                state='disabled'
+            )
+            display.pack(fill=tk.BOTH, expand=True)
+            stats_var = tk.StringVar(value="Oczekiwanie...")
+            ttk.Label(frame, textvariable=stats_var).pack(anchor=tk.W)
+            self.columns.append((display, stats_var))
+        self.results_frame.rowconfigure(0, weight=1)
+
+        self.pending = len(variants)
+        self.started_at = time.perf_counter()
+        self.summary_var.set("Generowanie...")
+        # Do końca porównania nie można uruchomić następnego; każde ma własną kolejkę,
+        # więc zdarzenia z poprzedniego nigdy nie trafią do nowych kolumn
+        self.send_button.config(state='disabled')
+        self.events = queue.Queue()
+        executor = ThreadPoolExecutor(max_workers=len(variants))
+        for index, variant in enumerate(variants):
+            executor.submit(self.run_variant, self.events, index, variant)
+        executor.shutdown(wait=False)
+        self.window.after(50, self.poll)
+
+    def run_variant(self, events, index, variant):
+        """Strumieniuje odpowiedź jednego wariantu (w wątku roboczym)"""
+        start = time.perf_counter()
+        first_token = None
+        try:
+            response = self.app.get_model(variant.model_name).generate_content(
+                contents=self.message,
+                generation_config=variant.generation_config(),
+                safety_settings=SAFETY_SETTINGS,
+                stream=True
+            )
+            for chunk in response:
+                if first_token is None:
+                    first_token = time.perf_counter()
+                if chunk.parts:
+                    events.put(('text', index, chunk.text))
+            end = time.perf_counter()
+            usage = getattr(response, 'usage_metadata', None)
+            output_tokens = getattr(usage, 'candidates_token_count', 0) or 0
+            prompt_tokens = getattr(usage, 'prompt_token_count', 0) or 0
+            generation_time = end - (first_token or start)
+            speed = output_tokens / generation_time if generation_time > 0 else 0.0
+            events.put(('done', index, (
+                f"Czas: {end - start:.2f} s | pierwszy token: "
+                f"{(first_token or end) - start:.2f} s | "
+                f"tokeny: {prompt_tokens} wej. / {output_tokens} wyj. | "
+                f"{speed:.1f} tok/s"
+            )))
+        except Exception as e:
+            events.put(('error', index, f"Błąd API: {str(e)}"))
+
+    def poll(self):
+        """Przenosi zdarzenia z wątków roboczych do widżetów (w wątku Tk)"""
+        if not self.window.winfo_exists():
+            return
+        try:
+            while True:
+                kind, index, payload = self.events.get_nowait()
+                display, stats_var = self.columns[index]
+                if kind == 'text':
+                    display.config(state='normal')
+                    display.insert(tk.END, payload)
+                    display.config(state='disabled')
+                    display.see(tk.END)
+                    continue
+                stats_var.set(payload)
+                self.pending -= 1
+        except queue.Empty:
+            pass
+
+        if self.pending:
+            self.window.after(50, self.poll)
+        else:
+            self.send_button.config(state='normal')
+            self.summary_var.set(
+                f"Całkowity czas: {time.perf_counter() - self.started_at:.2f} s"
+            )
+
+
+EXPORT_FORMATS = {
+    '.txt': 'txt',
+    '.md': 'md',
+    '.markdown': 'md',
+    '.html': 'html',
+    '.htm': 'html',
+}
+EXPORT_ROLE_LABELS = {'user': "Ty", 'bot': "AI", 'error': "BŁĄD"}
+HTML_EXPORT_HEAD = """<!DOCTYPE html>
+<html lang="pl">
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<style>
+body {{ font-family: Arial, sans-serif; max-width: 900px; margin: 2em auto; line-height: 1.5; }}
+.message {{ margin-bottom: 1.5em; white-space: pre-wrap; }}
+.role {{ font-weight: bold; }}
+.user .role {{ color: #0066cc; }}
+.bot .role {{ color: #009933; }}
+.error {{ color: #cc0000; }}
+.formula-block {{ display: block; text-align: center; margin: 0.5em 0; }}
+svg, img {{ vertical-align: middle; }}
+</style>
+</head>
+<body>
+"""
+
+
+_math_figure_class = None
+
+
+def load_math_renderer():
+    """
+    Ładuje matplotlib dopiero przy pierwszej formule, dzięki czemu samo okno
+    czatu startuje bez niego. Zwraca klasę Figure (backend Agg, bez pyplot).
+    """
+    global _math_figure_class
+    if _math_figure_class is None:
+        import matplotlib
+        matplotlib.use('Agg')
+        from matplotlib.figure import Figure
+
+        # Configure Matplotlib for LaTeX rendering (requires a LaTeX distribution like TeX Live/MiKTeX)
+        try:
+            matplotlib.rcParams['text.usetex'] = True
+            matplotlib.rcParams['font.family'] = LATEX_FONT_FAMILY
+            matplotlib.rcParams['font.serif'] = LATEX_FONT_SERIF
+        except Exception as e:
+            print(f"Warning: LaTeX configuration for Matplotlib failed. Ensure you have a LaTeX distribution (e.g., MiKTeX, TeX Live) installed and properly configured in your PATH. Math will be rendered as plain text or cause errors: {e}")
+        _math_figure_class = Figure
+    return _math_figure_class
+
+
+def formula_key(latex_string, block_mode):
+    """Krótki, stabilny identyfikator formuły (np. do nazw plików)"""
+    return hashlib.sha1(f"{int(block_mode)}:{latex_string}".encode('utf-8')).hexdigest()[:16]
+
+
+def conversation_formulas(history):
+    """Zwraca unikalne formuły (latex, block_mode) z wiadomości, w kolejności wystąpienia"""
+    formulas = {}
+    for role, msg in history:
+        for part in LATEX_PATTERN.split(msg):
+            formula = split_formula(part)
+            if formula is not None:
+                formulas[formula] = None
+    return list(formulas)
+
+
+def formula_render_settings():
+    """Skrót ustawień renderowania, którym oznaczane są paczki formuł"""
+    settings = [
+        FORMULA_BUNDLE_VERSION, LATEX_DPI, LATEX_FONT_FAMILY, LATEX_FONT_SERIF,
+        LATEX_FONT_SIZE_INLINE, LATEX_FONT_SIZE_BLOCK
+    ]
+    return hashlib.sha1(json.dumps(settings).encode('utf-8')).hexdigest()[:16]
+
+
+def formula_bundle_path(conversation_path):
+    return os.path.splitext(conversation_path)[0] + FORMULA_BUNDLE_EXTENSION
+
+
+def read_formula_bundle(path):
+    """
+    Wczytuje paczkę formuł jednym odczytem. Zwraca {klucz formuły: PNG} albo pusty
+    słownik, gdy paczki nie ma lub powstała przy innych ustawieniach renderowania.
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        header_end = data.index(b'\n')
+        header = json.loads(data[:header_end])
+    except (OSError, ValueError):
+        return {}
+    if header.get("settings") != formula_render_settings():
+        return {}
+    blobs = memoryview(data)[header_end + 1:]
+    return {
+        key: blobs[offset:offset + length]
+        for key, (offset, length) in header.get("formulas", {}).items()
+    }
+
+
+def write_formula_bundle(path, pngs):
+    """
+    Zapisuje paczkę: wiersz nagłówka JSON (ustawienia i położenie każdego PNG),
+    a za nim wszystkie PNG jeden za drugim.
+    """
+    index = {}
+    offset = 0
+    for key, png in pngs.items():
+        index[key] = [offset, len(png)]
+        offset += len(png)
+    header = {"settings": formula_render_settings(), "formulas": index}
+    tmp_path = f"{path}.{os.getpid()}.{get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(json.dumps(header).encode('utf-8') + b'\n')
+        for png in pngs.values():
+            f.write(png)
+    os.replace(tmp_path, path)
+
+
+def render_formula_svg(latex_string, block_mode=False):
+    """
+    Renderuje formułę do SVG przez mathtext matplotlib (bez pyplot i bez LaTeX-a),
+    dzięki czemu działa w procesach puli. Zwraca None w razie błędu.
+    """
+    try:
+        from matplotlib.figure import Figure
+        fig = Figure(figsize=(0.01, 0.01))
+        # usetex=False: procesy z fork dziedziczą text.usetex=True z okna czatu
+        fig.text(0, 0, f"${latex_string}$", fontsize=18 if block_mode else 14, usetex=False)
+        buf = io.StringIO()
+        fig.savefig(buf, format='svg', bbox_inches='tight', pad_inches=0.01, transparent=True)
+        svg = buf.getvalue()
+        # Do osadzenia w HTML potrzebny jest sam element <svg>
+        return svg[svg.index('<svg'):]
+    except Exception as e:
+        print(f"Error rendering formula to SVG: {e}")
+        return None
+
+
+def export_process_pool():
+    """
+    Pula procesów eksportu. Procesy są uruchamiane od nowa (spawn), a nie forkowane:
+    fork z wątku działającej aplikacji kopiuje blokady trzymane przez inne wątki
+    (strumieniowanie, rozgrzewanie, indeks historii) i proces potomny może się zawiesić.
+    """
+    return ProcessPoolExecutor(mp_context=multiprocessing.get_context('spawn'))
+
+
+class ConversationExporter:
+    """
+    Eksport konwersacji do TXT, Markdown lub samodzielnego HTML.
+    Wiadomości są zapisywane do pliku po kolei, bez budowania całego wyniku w pamięci.
+    Formuły są zamieniane na obrazki: wyrenderowane już w oknie czatu PNG są używane
+    ponownie, a pozostałe renderowane do SVG (opcjonalnie w puli procesów,
+    tworzonej przez pool_factory dopiero wtedy, gdy jest co renderować).
+    """
+    def __init__(self, filepath, system_prompt, png_lookup=None, pool_factory=None):
+        self.filepath = filepath
+        self.system_prompt = system_prompt
+        self.format = EXPORT_FORMATS.get(Path(filepath).suffix.lower(), 'txt')
+        self.png_lookup = png_lookup or (lambda key: None)
+        self.pool_factory = pool_factory
+        self.pool = None
+        self.formulas = {}
+        self.written_assets = set()
+        stem = Path(filepath).stem
+        self.assets_dir = Path(filepath).with_name(f"{stem}_files")
+
+    def export(self, history):
+        try:
+            if self.format != 'txt':
+                self.prepare_formulas(history)
+            with open(self.filepath, 'w', encoding='utf-8') as f:
+                getattr(self, f"write_{self.format}")(f, history)
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown()
+        return self.filepath
+
+    def prepare_formulas(self, history):
+        """Zleca renderowanie wszystkich (unikalnych) formuł z góry"""
+        for role, msg in history:
+            for part in LATEX_PATTERN.split(msg):
+                formula = split_formula(part)
+                if formula is None or formula in self.formulas:
+                    continue
+                png = self.png_lookup(formula)
+                if png is not None:
+                    self.formulas[formula] = ('png', png)
+                elif self.pool_factory is not None:
+                    if self.pool is None:
+                        self.pool = self.pool_factory()
+                    self.formulas[formula] = ('future', self.pool.submit(render_formula_svg, *formula))
+                else:
+                    self.formulas[formula] = ('svg', None)
+
+    def formula_image(self, formula):
+        """Zwraca ('png'|'svg', dane) lub None, gdy formuły nie udało się wyrenderować"""
+        kind, data = self.formulas[formula]
+        if kind == 'future':
+            data = data.result()
+            kind = 'svg'
+        elif kind == 'svg' and data is None:
+            data = render_formula_svg(*formula)
+        self.formulas[formula] = (kind, data)
+        return (kind, data) if data is not None else None
+
+    def write_txt(self, f, history):
+        # Nagłówek
+        f.write("=== Konwersacja Gemini Chat ===\n")
+        f.write(f"Data: {datetime.now().strftime('%Y-%m-%d %H:%M')}\n")
+        f.write(f"Prompt systemowy: {self.system_prompt}\n\n")
+        
+        # Historia
+        for role, msg in history:
+            prefix = "UŻYTKOWNIK: " if role == "user" else "ASYSTENT: "
+            f.write(f"{prefix}{msg}\n\n")
+
+    def write_md(self, f, history):
+        f.write("# Konwersacja Gemini Chat\n\n")
+        f.write(f"*Data: {datetime.now().strftime('%Y-%m-%d %H:%M')}*\n\n")
+        f.write(f"**Prompt systemowy:** {self.system_prompt}\n\n")
+        for role, msg in history:
+            f.write(f"### {EXPORT_ROLE_LABELS.get(role, role.capitalize())}\n\n")
+            for part in LATEX_PATTERN.split(msg):
+                formula = split_formula(part)
+                image = formula and self.formula_image(formula)
+                if not image:
+                    f.write(part)
+                    continue
+                path = self.write_asset(formula, *image)
+                alt = formula[0].replace('[', '(').replace(']', ')')
+                link = f"![{alt}]({self.assets_dir.name}/{path.name})"
+                f.write(f"\n\n{link}\n\n" if formula[1] else link)
+            f.write("\n\n")
+
+    def write_asset(self, formula, kind, data):
+        path = self.assets_dir / f"formula_{formula_key(*formula)}.{kind}"
+        if path not in self.written_assets:
+            self.assets_dir.mkdir(exist_ok=True)
+            if kind == 'png':
+                path.write_bytes(data)
+            else:
+                path.write_text(data, encoding='utf-8')
+            self.written_assets.add(path)
+        return path
+
+    def write_html(self, f, history):
+        f.write(HTML_EXPORT_HEAD.format(title=html.escape(Path(self.filepath).stem)))
+        f.write("<h1>Konwersacja Gemini Chat</h1>\n")
+        f.write(f"<p><em>Data: {datetime.now().strftime('%Y-%m-%d %H:%M')}</em></p>\n")
+        f.write(f"<p><strong>Prompt systemowy:</strong> {html.escape(self.system_prompt)}</p>\n")
+        for role, msg in history:
+            label = EXPORT_ROLE_LABELS.get(role, role.capitalize())
+            f.write(f'<div class="message {html.escape(role)}"><span class="role">{html.escape(label)}:</span> ')
+            for part in LATEX_PATTERN.split(msg):
+                formula = split_formula(part)
+                image = formula and self.formula_image(formula)
+                if not image:
+                    f.write(html.escape(part))
+                    continue
+                kind, data = image
+                if kind == 'png':
+                    element = (
+                        f'<img alt="{html.escape(formula[0], quote=True)}" src="data:image/png;base64,'
+                        f'{base64.b64encode(data).decode("ascii")}">'
+                    )
+                else:
+                    element = data
+                if formula[1]:
+                    element = f'<span class="formula-block">{element}</span>'
+                f.write(element)
+            f.write("</div>\n")
+        f.write("</body>\n</html>\n")
+
+
+def split_formula(part):
+    """Zwraca klucz (latex, block_mode) dla fragmentu z formułą lub None dla zwykłego tekstu"""
+    if len(part) > 4 and part.startswith('$$') and part.endswith('$$'):
+        return (part[2:-2].strip(), True)
+    if len(part) > 2 and part.startswith('$') and part.endswith('$'):
+        return (part[1:-1].strip(), False)
+    return None
+
+
+def export_conversation_file(json_path, out_dir, extension):
+    """Eksportuje zapisaną konwersację (funkcja dla puli procesów przy eksporcie zbiorczym)"""
+    with open(json_path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    out_path = os.path.join(out_dir, Path(json_path).stem + extension)
+    bundle = read_formula_bundle(formula_bundle_path(json_path))
+    return ConversationExporter(
+        out_path,
+        data.get("system_prompt", ""),
+        png_lookup=lambda formula: bundle.get(formula_key(*formula))
+    ).export(load_conversation_data(data)[0])
+
+
+# === Wyszukiwanie w historii konwersacji ===
+HISTORY_INDEX_DIR = "history_index"
+HISTORY_EMBEDDING_DIM = 256
+HISTORY_TOP_K = 8
+# Ile (w przybliżeniu) tokenów mogą zająć dołączone fragmenty historii
+HISTORY_TOKEN_BUDGET = 1000
+HISTORY_SNIPPET_CHARS = 800
+# Fragmenty mniej podobne do pytania nie są dołączane
+HISTORY_MIN_SCORE = 0.25
+HISTORY_EMBED_BATCH = 2048
+HISTORY_WORD_PATTERN = re.compile(r"\w+")
+
+
+class HashedNgramEmbedder:
+    """
+    Domyślny embedder: słowa i trigramy znaków rzutowane funkcją skrótu na wektor
+    o stałym wymiarze. Nie potrzebuje modelu ani sieci i działa na CPU.
+    Inny embedder musi mieć atrybuty name i dim oraz metodę embed(texts)
+    zwracającą znormalizowaną macierz float32 (wiersz na tekst).
+    """
+    def __init__(self, dim=HISTORY_EMBEDDING_DIM):
+        self.dim = dim
+        self.name = f"hashed-ngrams-{dim}"
+        self.words = {} # słowo -> (kolumny, znaki) jego cech
+
+    def word_features(self, word):
+        features = self.words.get(word)
+        if features is None:
+            padded = f" {word} "
+            tokens = [f"w:{word}"] + [padded[i:i + 3] for i in range(len(padded) - 2)]
+            hashes = [zlib.crc32(token.encode('utf-8')) for token in tokens]
+            features = (
+                [h % self.dim for h in hashes],
+                [1.0 if h & 0x80000000 else -1.0 for h in hashes]
+            )
+            if len(self.words) > 200_000:
+                self.words.clear()
+            self.words[word] = features
+        return features
+
+    def embed(self, texts):
+        import numpy as np
+        columns, signs, lengths = [], [], []
+        for text in texts:
+            before = len(columns)
+            for word in HISTORY_WORD_PATTERN.findall(text.lower()):
+                word_columns, word_signs = self.word_features(word)
+                columns.extend(word_columns)
+                signs.extend(word_signs)
+            lengths.append(len(columns) - before)
+        rows = np.repeat(np.arange(len(texts), dtype=np.int64) * self.dim, lengths)
+        matrix = np.bincount(
+            rows + np.asarray(columns, dtype=np.int64),
+            weights=np.asarray(signs, dtype=np.float64),
+            minlength=len(texts) * self.dim
+        ).astype(np.float32).reshape(len(texts), self.dim)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return matrix / np.maximum(norms, 1e-12)
+
+
+class HistoryIndex:
+    """
+    Lokalny indeks wektorowy wiadomości z zapisanych konwersacji.
+    Wektory są znormalizowane i leżą w jednej macierzy NumPy, więc podobieństwo
+    kosinusowe do pytania to jedno mnożenie macierzy przez wektor.
+    Zapis konwersacji tylko dopisuje nowe wiersze na końcu plików indeksu;
+    usunięte konwersacje są oznaczane i wycinane przy następnym wczytaniu.
+    NumPy i sam indeks są ładowane dopiero przy pierwszym użyciu.
+    """
+    def __init__(self, index_dir, conversations_dir, embedder=None):
+        self.index_dir = index_dir
+        self.conversations_dir = conversations_dir
+        self.embedder = embedder or HashedNgramEmbedder()
+        self.vectors_path = os.path.join(index_dir, "vectors.f32")
+        self.entries_path = os.path.join(index_dir, "entries.jsonl")
+        self.lock = Lock()
+        self.loaded = False
+
+    def header(self):
+        return {"embedder": self.embedder.name, "dim": self.embedder.dim}
+
+    def reset(self):
+        import numpy as np
+        self.matrix = np.empty((0, self.embedder.dim), dtype=np.float32)
+        self.alive = np.empty(0, dtype=bool)
+        self.count = 0 # zajęte wiersze macierzy, reszta to zapas na dopisywanie
+        self.entries = [] # wiersz -> (id konwersacji, pozycja wiadomości)
+        self.rows = {} # id konwersacji -> jej wiersze
+        self.indexed = {} # id konwersacji -> liczba przejrzanych wiadomości
+
+    # --- Pliki ---
+    def load(self):
+        """Wczytuje indeks z dysku (wywoływane pod blokadą), w razie potrzeby budując go od nowa"""
+        if self.loaded:
+            return
+        import numpy as np
+        self.loaded = True
+        self.reset()
+        try:
+            index_mtime = os.path.getmtime(self.entries_path)
+            with open(self.entries_path, 'r', encoding='utf-8') as f:
+                header = json.loads(f.readline())
+                lines = [json.loads(line) for line in f]
+            vectors = np.fromfile(self.vectors_path, dtype=np.float32)
+        except (OSError, ValueError):
+            header = None
+        if header != self.header():
+            self.rebuild()
+            return
+
+        dim = self.embedder.dim
+        vectors = vectors[:len(vectors) // dim * dim].reshape(-1, dim)
+        entries = []
+        removed = set()
+        for line in lines:
+            if isinstance(line, dict):
+                conversation_id = line["remove"]
+                removed.update(i for i, entry in enumerate(entries) if entry[0] == conversation_id)
+            else:
+                entries.append(tuple(line))
+        # Wiersze bez wektora (przerwany zapis) i usunięte konwersacje wycinamy
+        keep = [i for i in range(min(len(entries), len(vectors))) if i not in removed]
+        if len(keep) != len(entries) or len(keep) != len(vectors):
+            vectors = vectors[keep]
+            entries = [entries[i] for i in keep]
+            self.append_rows(vectors, entries)
+            self.write_files()
+        else:
+            self.append_rows(vectors, entries)
+        self.sync(index_mtime)
+
+    def write_files(self):
+        os.makedirs(self.index_dir, exist_ok=True)
+        self.matrix[:self.count].tofile(self.vectors_path)
+        with open(self.entries_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(self.header()) + "\n")
+            for entry in self.entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def append_files(self, vectors, entries, removed=None):
+        # Najpierw wektory: wpis bez wektora jest przy wczytaniu odrzucany
+        with open(self.vectors_path, 'ab') as f:
+            f.write(vectors.tobytes())
+        with open(self.entries_path, 'a', encoding='utf-8') as f:
+            if removed is not None:
+                f.write(json.dumps({"remove": removed}, ensure_ascii=False) + "\n")
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def conversation_files(self):
+        for filename in os.listdir(self.conversations_dir):
+            if filename.endswith('.json'):
+                yield os.path.splitext(filename)[0], os.path.join(self.conversations_dir, filename)
+
+    def read_messages(self, path):
+        with open(path, 'r', encoding='utf-8') as f:
+            return load_conversation_data(json.load(f))[0]
+
+    def rebuild(self):
+        """Buduje indeks od zera ze wszystkich zapisanych konwersacji"""
+        self.reset()
+        self.write_files()
+        for conversation_id, path in self.conversation_files():
+            try:
+                self.add_messages(conversation_id, self.read_messages(path))
+            except (OSError, ValueError, KeyError):
+                continue
+
+    def sync(self, index_mtime):
+        """Uwzględnia konwersacje zmienione poza oknem aplikacji (np. przez tryb serwera)"""
+        existing = set()
+        for conversation_id, path in self.conversation_files():
+            existing.add(conversation_id)
+            try:
+                if os.path.getmtime(path) > index_mtime:
+                    self.add_messages(conversation_id, self.read_messages(path))
+            except (OSError, ValueError, KeyError):
+                continue
+        for conversation_id in set(self.rows) - existing:
+            self.remove_rows(conversation_id)
+
+    # --- Macierz ---
+    def append_rows(self, vectors, entries):
+        import numpy as np
+        needed = self.count + len(entries)
+        if needed > len(self.matrix):
+            capacity = max(needed, 2 * len(self.matrix), 1024)
+            matrix = np.empty((capacity, self.embedder.dim), dtype=np.float32)
+            matrix[:self.count] = self.matrix[:self.count]
+            alive = np.zeros(capacity, dtype=bool)
+            alive[:self.count] = self.alive[:self.count]
+            self.matrix, self.alive = matrix, alive
+        self.matrix[self.count:needed] = vectors
+        self.alive[self.count:needed] = True
+        for row, (conversation_id, position) in enumerate(entries, self.count):
+            self.rows.setdefault(conversation_id, []).append(row)
+            self.indexed[conversation_id] = max(self.indexed.get(conversation_id, 0), position + 1)
+        self.entries.extend(entries)
+        self.count = needed
+
+    def add_messages(self, conversation_id, messages):
+        """Dopisuje wiadomości, których indeks jeszcze nie zna (konwersacje tylko rosną)"""
+        start = self.indexed.get(conversation_id, 0)
+        if len(messages) < start:
+            self.remove_rows(conversation_id)
+            start = 0
+        self.indexed[conversation_id] = len(messages)
+        new = [
+            (position, message.text)
+            for position, message in enumerate(messages[start:], start)
+            if message.role is not Role.ERROR and message.text.strip()
+        ]
+        for i in range(0, len(new), HISTORY_EMBED_BATCH):
+            batch = new[i:i + HISTORY_EMBED_BATCH]
+            vectors = self.embedder.embed([text for _, text in batch])
+            entries = [(conversation_id, position) for position, _ in batch]
+            self.append_files(vectors, entries)
+            self.append_rows(vectors, entries)
+
+    def remove_rows(self, conversation_id):
+        rows = self.rows.pop(conversation_id, [])
+        self.indexed.pop(conversation_id, None)
+        if rows:
+            self.alive[rows] = False
+            self.append_files(self.matrix[:0], [], removed=conversation_id)
+
+    # --- Interfejs ---
+    def update(self, conversation_id, messages):
+        """Wywoływane po zapisaniu konwersacji"""
+        with self.lock:
+            self.load()
+            self.add_messages(conversation_id, messages)
+
+    def remove(self, conversation_id):
+        """Wywoływane po usunięciu konwersacji"""
+        with self.lock:
+            self.load()
+            self.remove_rows(conversation_id)
+
+    def search(self, text, k=HISTORY_TOP_K):
+        """Zwraca do k par (podobieństwo, (id konwersacji, pozycja)), od najbardziej podobnej"""
+        import numpy as np
+        query = self.embedder.embed([text])[0]
+        with self.lock:
+            self.load()
+            if not self.count:
+                return []
+            scores = self.matrix[:self.count] @ query
+            scores[~self.alive[:self.count]] = -np.inf
+            k = min(k, self.count)
+            best = np.argpartition(-scores, k - 1)[:k]
+            best = best[np.argsort(-scores[best])]
+            return [
+                (float(scores[i]), self.entries[i])
+                for i in best if scores[i] >= HISTORY_MIN_SCORE
+            ]
+
+    def context_for(self, text, token_budget=HISTORY_TOKEN_BUDGET):
+        """
+        Tekst z fragmentami wcześniejszych rozmów podobnymi do pytania
+        (najpierw najbardziej podobne, łącznie w limicie tokenów) albo pusty tekst.
+        """
+        budget = token_budget * 4 # ~4 znaki na token
+        conversations = {}
+        snippets = []
+        for _, (conversation_id, position) in self.search(text):
+            if conversation_id not in conversations:
+                try:
+                    conversations[conversation_id] = self.read_messages(
+                        os.path.join(self.conversations_dir, f"{conversation_id}.json")
+                    )
+                except (OSError, ValueError, KeyError):
+                    conversations[conversation_id] = []
+            messages = conversations[conversation_id]
+            if position >= len(messages) or messages[position].text.strip() == text.strip():
+                continue
+            role, snippet = messages[position]
+            snippet = f"[{conversation_id}] {EXPORT_ROLE_LABELS.get(role, role)}: {snippet[:HISTORY_SNIPPET_CHARS]}"
+            if len(snippet) > budget:
+                break
+            budget -= len(snippet)
+            snippets.append(snippet)
+        if not snippets:
+            return ""
+        return "Fragmenty wcześniejszych rozmów, które mogą się przydać:\n\n" + "\n\n".join(snippets) + "\n\n"
+
+
+def benchmark_history_index(count):
+    """Mierzy budowę indeksu i czas zapytań na syntetycznych wiadomościach (--benchmark-history)"""
+    import random
+    import statistics
+    import tempfile
+
+    rng = random.Random(0)
+    vocabulary = [
+        "".join(rng.choice("abcdefghijklmnoprstuwyząęółśżź") for _ in range(rng.randint(3, 10)))
+        for _ in range(20000)
+    ]
+    def sentence():
+        return " ".join(rng.choice(vocabulary) for _ in range(rng.randint(10, 60)))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        index = HistoryIndex(os.path.join(tmp, HISTORY_INDEX_DIR), tmp)
+        per_conversation = 100
+        messages = [Message(Role.USER if i % 2 == 0 else Role.BOT, sentence()) for i in range(count)]
+
+        start = time.perf_counter()
+        for i in range(0, count, per_conversation):
+            index.update(f"conv_{i // per_conversation}", messages[i:i + per_conversation])
+        build = time.perf_counter() - start
+
+        queries = [sentence() for _ in range(200)]
+        times = []
+        for query in queries:
+            start = time.perf_counter()
+            index.search(query)
+            times.append(time.perf_counter() - start)
+        times.sort()
+
+        start = time.perf_counter()
+        HistoryIndex(index.index_dir, tmp).load()
+        reload = time.perf_counter() - start
+
+        print(f"Wiadomości: {count}, embedder: {index.embedder.name}")
+        print(f"Budowa indeksu: {build:.2f} s ({count / build:.0f} wiad./s)")
+        print(f"Wczytanie z dysku: {reload:.2f} s")
+        print(f"Zapytanie: mediana {statistics.median(times) * 1000:.1f} ms, "
+              f"p95 {times[int(len(times) * 0.95)] * 1000:.1f} ms")
+        print(f"Macierz: {index.matrix[:index.count].nbytes / 1e6:.1f} MB")
+
+
+def benchmark_display(app, count):
+    """
+    Porównuje odtworzenie historii w karcie (--benchmark-display): dawne wstawianie
+    fragment po fragmencie z przełączaniem stanu i przewijaniem po każdej wiadomości
+    z obecnym display_messages. Wiadomości są bez formuł, żeby mierzyć sam widżet.
+    """
+    import random
+
+    rng = random.Random(0)
+    words = ["odpowiedź", "model", "funkcja", "wynik", "zapytanie", "tekst", "dane", "przykład"]
+    messages = [
+        ('user' if i % 2 == 0 else 'bot',
+         "\n".join(" ".join(rng.choice(words) for _ in range(rng.randint(8, 20)))
+                   for _ in range(rng.randint(1, 8))))
+        for i in range(count)
+    ]
+
+    def per_message(tab):
+        for sender, text in messages:
+            tab.chat_display.config(state='normal')
+            for segment in app.build_message_segments(sender, text, []):
+                tab.chat_display.insert(tk.END, segment[1], segment[2])
+            tab.chat_display.config(state='disabled')
+            tab.chat_display.see(tk.END)
+
+    results = []
+    for name, replay in (("fragment po fragmencie", per_message),
+                         ("display_messages", lambda tab: app.display_messages(messages, tab))):
+        tab = app.open_tab("Benchmark")
+        app.root.update()
+        start = time.perf_counter()
+        replay(tab)
+        app.root.update() # Uwzględniamy układ i odrysowanie widżetu
+        results.append((name, time.perf_counter() - start))
+
+    print(f"Wiadomości: {count}")
+    for name, elapsed in results:
+        print(f"{name}: {elapsed * 1000:.0f} ms")
+    print(f"Przyspieszenie: {results[0][1] / results[1][1]:.1f}x")
+
+
+# === Tryb serwera (--serve) ===
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8765
+# Ile połączeń naraz obsługuje serwer
+SERVER_MAX_CLIENTS = 256
+# Ile zapytań naraz może wysłać jeden klient (X-Client-Id, a bez niego adres IP)
+SERVER_MAX_REQUESTS_PER_CLIENT = 4
+# Ile sekund klient ma na przesłanie całego zapytania, zanim zwolnimy jego połączenie
+SERVER_REQUEST_TIMEOUT = 10
+# Ile zapytań do modelu może trwać jednocześnie; kolejne czekają w kolejce
+SERVER_MAX_GENERATIONS = 16
+SERVER_MAX_BODY = 1024 * 1024
+# Ile fragmentów odpowiedzi może czekać na wolnego klienta, zanim wstrzymamy strumień z API
+SERVER_STREAM_BUFFER = 32
+HTTP_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    408: "Request Timeout",
+    413: "Payload Too Large",
+    429: "Too Many Requests",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+}
+
+
+class HttpError(Exception):
+    """Błąd zapytania zwracany klientowi jako odpowiedź JSON"""
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class ChatServer:
+    """
+    Lokalny serwer HTTP/SSE udostępniający preprompty, zapisane konwersacje
+    i wysyłanie wiadomości innym narzędziom, bez okna aplikacji.
+    Działa na pętli asyncio; zapytania do modelu idą w wątkach, a ich strumień
+    trafia do klienta przez ograniczoną kolejkę, więc wolny klient spowalnia
+    odczyt z API zamiast zapełniać pamięć.
+    Dane (conversations/, preprompts.db) są współdzielone z oknem aplikacji:
+    konwersacje zapisujemy atomowo, a zmiany bazy prepromptów wykrywamy przed każdym użyciem.
+    """
+    def __init__(self, app_data_dir, host=SERVER_HOST, port=SERVER_PORT):
+        self.host = host
+        self.port = port
+        self.conversations_dir = os.path.join(app_data_dir, CONVERSATIONS_DIR)
+        os.makedirs(self.conversations_dir, exist_ok=True)
+        self.preprompt_store = PrepromptStore(
+            os.path.join(app_data_dir, PREPROMPTS_DB),
+            legacy_json=os.path.join(app_data_dir, PREPROMPTS_JSON)
+        )
+        with open(os.path.join(app_data_dir, API_KEY_FILE), "r") as f:
+            self.client = GeminiClient(f.read().strip())
+        self.context_cache = ContextCache(os.path.join(app_data_dir, CONTEXT_CACHE_FILE))
+        self.clients = 0
+        self.requests_per_client = {}
+        self.conversation_locks = {}
+        # Cache odczytanych konwersacji: ścieżka -> (mtime, dane)
+        self.conversation_cache = {}
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self.generations = asyncio.Semaphore(SERVER_MAX_GENERATIONS)
+        server = await asyncio.start_server(self.handle_client, self.host, self.port)
+        print(f"Serving on http://{self.host}:{self.port}")
+        # Rozgrzanie połączenia z API, zanim przyjdzie pierwsze zapytanie
+        asyncio.get_running_loop().run_in_executor(None, self.client.warm_up)
+        async with server:
+            await server.serve_forever()
+
+    # --- HTTP ---
+    async def handle_client(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        host = peer[0] if peer else SERVER_HOST
+        if self.clients >= SERVER_MAX_CLIENTS:
+            await self.send_json(writer, 503, {"error": "Serwer jest przeciążony"})
+            writer.close()
+            return
+        self.clients += 1
+        try:
+            try:
+                method, path, query, headers, body = await asyncio.wait_for(
+                    self.read_request(reader), SERVER_REQUEST_TIMEOUT
+                )
+            except asyncio.TimeoutError:
+                raise HttpError(408, "Przekroczono czas na przesłanie zapytania")
+            # Wszyscy lokalni klienci mają ten sam adres IP, więc narzędzia mogą się
+            # rozróżnić nagłówkiem X-Client-Id; bez niego dzielą jeden limit adresu
+            client = headers.get('x-client-id') or host
+            active = self.requests_per_client.get(client, 0)
+            if active >= SERVER_MAX_REQUESTS_PER_CLIENT:
+                raise HttpError(429, "Za dużo równoczesnych zapytań")
+            self.requests_per_client[client] = active + 1
+            try:
+                await self.dispatch(writer, method, path, query, body)
+            finally:
+                self.requests_per_client[client] -= 1
+                if not self.requests_per_client[client]:
+                    del self.requests_per_client[client]
+        except HttpError as e:
+            await self.send_json(writer, e.status, {"error": str(e)})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            print(f"Server error: {e}")
+            try:
+                await self.send_json(writer, 500, {"error": str(e)})
+            except ConnectionError:
+                pass
+        finally:
+            self.clients -= 1
+            writer.close()
+
+    async def read_request(self, reader):
+        request_line = (await reader.readline()).decode('latin-1').strip()
+        try:
+            method, target, _ = request_line.split(' ', 2)
+        except ValueError:
+            raise HttpError(400, "Niepoprawne zapytanie")
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1').strip()
+            if not line:
+                break
+            key, _, value = line.partition(':')
+            headers[key.strip().lower()] = value.strip()
+
+        length = int(headers.get('content-length') or 0)
+        if length > SERVER_MAX_BODY:
+            raise HttpError(413, "Zbyt duże zapytanie")
+        body = await reader.readexactly(length) if length else b""
+
+        parsed = urllib.parse.urlsplit(target)
+        query = dict(urllib.parse.parse_qsl(parsed.query))
+        path = urllib.parse.unquote(parsed.path).rstrip('/') or '/'
+        return method.upper(), path, query, headers, body
+
+    async def send_json(self, writer, status, data):
+        payload = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        writer.write(
+            f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}\r\n"
+            "Content-Type: application/json; charset=utf-8\r\n"
+            f"Content-Length: {len(payload)}\r\n"
+            "Connection: close\r\n\r\n".encode('latin-1') + payload
+        )
+        await writer.drain()
+
+    async def send_event(self, writer, event, data):
+        writer.write(
+            f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode('utf-8')
+        )
+        # drain() czeka, aż klient odbierze dane - to jest nasza kontrola przepływu
+        await writer.drain()
+
+    async def dispatch(self, writer, method, path, query, body):
+        parts = path.strip('/').split('/')
+        if path == '/health':
+            return await self.send_json(writer, 200, {"status": "ok"})
+        if parts[0] == 'preprompts':
+            if method != 'GET':
+                raise HttpError(405, "Dozwolona metoda: GET")
+            if len(parts) == 1:
+                return await self.send_json(writer, 200, self.list_preprompts(query))
+            return await self.send_json(writer, 200, self.get_preprompt(parts[1]))
+        if parts[0] == 'conversations':
+            if method != 'GET':
+                raise HttpError(405, "Dozwolona metoda: GET")
+            loop = asyncio.get_running_loop()
+            if len(parts) == 1:
+                result = await loop.run_in_executor(None, self.list_conversations, query)
+            else:
+                result = await loop.run_in_executor(None, self.load_conversation, parts[1])
+            return await self.send_json(writer, 200, result)
+        if parts[0] == 'messages':
+            if method != 'POST':
+                raise HttpError(405, "Dozwolona metoda: POST")
+            return await self.send_message(writer, self.parse_json(body))
+        raise HttpError(404, "Nie znaleziono")
+
+    @staticmethod
+    def parse_json(body):
+        try:
+            data = json.loads(body or b"{}")
+        except ValueError:
+            raise HttpError(400, "Niepoprawny JSON")
+        if not isinstance(data, dict):
+            raise HttpError(400, "Oczekiwano obiektu JSON")
+        return data
+
+    # --- Preprompty ---
+    def list_preprompts(self, query):
+        self.preprompt_store.refresh_if_changed()
+        return {"preprompts": self.preprompt_store.search(query.get('q', ''))}
+
+    def get_preprompt(self, name):
+        self.preprompt_store.refresh_if_changed()
+        body = self.preprompt_store.get(name)
+        if body is None:
+            raise HttpError(404, f"Nie ma prepromptu '{name}'")
+        return {"name": name, "body": body}
+
+    def render_preprompt(self, source, history):
+        """
+        Renderuje preprompt tak jak okno aplikacji (schowek jest tu zawsze pusty).
+        Zwraca (treść, czy_szablon_jest_stały).
+        """
+        def previous_reply(n=1):
+            replies = [msg for role, msg in history if role == 'bot']
+            return replies[-n] if len(replies) >= n else ""
+
+        context = {
+            'language': lambda arg: DEFAULT_LANGUAGE,
+            'date': lambda arg: datetime.now().strftime(arg or '%Y-%m-%d'),
+            'time': lambda arg: datetime.now().strftime(arg or '%H:%M'),
+            'clipboard': lambda arg: "",
+            'reply': previous_reply,
+        }
+        try:
+            template = PrepromptTemplate.compile(source).compose(self.preprompt_store.get)
+            return template.render(context), template.is_static
+        except PrepromptTemplateError as e:
+            raise HttpError(400, f"Błąd szablonu: {e}")
+
+    # --- Konwersacje ---
+    def conversation_path(self, conversation_id):
+        if (not conversation_id or conversation_id.startswith('.')
+                or os.path.basename(conversation_id) != conversation_id):
+            raise HttpError(400, "Niepoprawny identyfikator konwersacji")
+        return os.path.join(self.conversations_dir, f"{conversation_id}.json")
+
+    def read_conversation(self, path):
+        mtime = os.stat(path).st_mtime_ns
+        cached = self.conversation_cache.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        self.conversation_cache[path] = (mtime, data)
+        return data
+
+    def load_conversation(self, conversation_id):
+        path = self.conversation_path(conversation_id)
+        if not os.path.exists(path):
+            raise HttpError(404, f"Nie ma konwersacji '{conversation_id}'")
+        data = self.read_conversation(path)
+        if data.get("version", 1) < CONVERSATION_FORMAT_VERSION:
+            messages, preprompts = load_conversation_data(data)
+            data = conversation_to_data(
+                messages, preprompts, data.get("system_prompt", ""), data.get("created_at")
+            )
+        return dict(data, id=conversation_id)
+
+    def list_conversations(self, query):
+        """Lista konwersacji; parametr q filtruje po treści wiadomości"""
+        needle = query.get('q', '').lower()
+        results = []
+        for filename in sorted(os.listdir(self.conversations_dir), reverse=True):
+            if not filename.endswith('.json'):
+                continue
+            path = os.path.join(self.conversations_dir, filename)
+            try:
+                data = self.read_conversation(path)
+            except (OSError, ValueError):
+                continue
+            messages = data.get("messages") or data.get("history", [])
+            texts = (m["text"] if isinstance(m, dict) else m[1] for m in messages)
+            if needle and not any(needle in text.lower() for text in texts):
+                continue
+            results.append({
+                "id": os.path.splitext(filename)[0],
+                "created_at": data.get("created_at"),
+                "messages": len(messages),
+            })
+        return {"conversations": results}
+
+    # --- Wiadomości ---
+    async def send_message(self, writer, request):
+        for field in ("message", "system_prompt", "preprompt", "conversation_id", "model"):
+            if request.get(field) is not None and not isinstance(request[field], str):
+                raise HttpError(400, f"Pole '{field}' musi być tekstem")
+        user_text = request.get("message", "").strip()
+        if not user_text:
+            raise HttpError(400, "Brak pola 'message'")
+        model_name = request.get("model") or DEFAULT_MODEL_NAME
+
+        conversation_id = request.get("conversation_id") or (
+            f"conv_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}"
+        )
+        path = self.conversation_path(conversation_id)
+        lock = self.conversation_locks.setdefault(conversation_id, asyncio.Lock())
+
+        async with lock:
+            if os.path.exists(path):
+                data = await asyncio.get_running_loop().run_in_executor(
+                    None, self.read_conversation, path
+                )
+            else:
+                data = {"version": CONVERSATION_FORMAT_VERSION, "system_prompt": ""}
+            history, preprompts = load_conversation_data(data)
+
+            self.preprompt_store.refresh_if_changed()
+            source = request.get("system_prompt")
+            if source is None and request.get("preprompt"):
+                source = self.preprompt_store.get(request["preprompt"])
+                if source is None:
+                    raise HttpError(404, f"Nie ma prepromptu '{request['preprompt']}'")
+            if source is None:
+                source = data.get("system_prompt", "")
+            source = source.strip()
+            preprompt, cacheable = self.render_preprompt(source, history)
+
+            stream = request.get("stream", True)
+            if stream:
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\n"
+                    b"Content-Type: text/event-stream; charset=utf-8\r\n"
+                    b"Cache-Control: no-cache\r\n"
+                    b"Connection: close\r\n\r\n"
+                )
+                await writer.drain()
+
+            chunks = []
+
+            async def on_chunk(text):
+                chunks.append(text)
+                if stream:
+                    await self.send_event(writer, "chunk", {"text": text})
+
+            async with self.generations:
+                start = time.perf_counter()
+                try:
+                    await self.stream_reply(preprompt, user_text, model_name, on_chunk, cacheable)
+                except ConnectionError:
+                    raise
+                except Exception as e:
+                    if not stream:
+                        raise HttpError(500, f"Błąd API: {e}")
+                    await self.send_event(writer, "error", {"error": f"Błąd API: {e}"})
+                    return
+                elapsed = time.perf_counter() - start
+
+            reply = "".join(chunks)
+            # Wiadomość wskazuje szablon, nie jego wynik - szablon ze zmiennymi
+            # (np. {{time}}) jest wtedy zapisany raz, a nie przy każdej wiadomości
+            pid = None
+            if source:
+                pid = preprompt_id(source)
+                preprompts[pid] = source
+            history.append(Message(Role.USER, user_text, pid))
+            history.append(Message(Role.BOT, reply))
+            data = conversation_to_data(history, preprompts, source, data.get("created_at"))
+            await asyncio.get_running_loop().run_in_executor(
+                None, write_json_atomic, path, data, True
+            )
+
+        result = {"conversation_id": conversation_id, "reply": reply, "elapsed": round(elapsed, 3)}
+        if stream:
+            await self.send_event(writer, "done", result)
+        else:
+            await self.send_json(writer, 200, result)
+
+    async def stream_reply(self, preprompt, user_text, model_name, on_chunk, cacheable=True):
+        """
+        Strumieniuje odpowiedź modelu do on_chunk. Wątek roboczy odczytuje fragmenty
+        z API i wkłada je do ograniczonej kolejki; gdy klient nie nadąża, wątek czeka.
+        """
+        loop = asyncio.get_running_loop()
+        chunks = asyncio.Queue(maxsize=SERVER_STREAM_BUFFER)
+        stop = Event()
+        done = object()
+
+        def put(item):
+            asyncio.run_coroutine_threadsafe(chunks.put(item), loop).result()
+
+        def worker():
+            try:
+                response, _ = generate_reply(
+                    self.client, self.context_cache, preprompt, user_text,
+                    model_name=model_name, stream=True, cacheable=cacheable
+                )
+                for chunk in response:
+                    if stop.is_set():
+                        return
+                    if chunk.parts:
+                        put(chunk.text)
+                item = done
+            except Exception as e:
+                item = e
+            if not stop.is_set():
+                put(item)
+
+        future = loop.run_in_executor(None, worker)
+        try:
+            while True:
+                item = await chunks.get()
+                if item is done:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                await on_chunk(item)
+        finally:
+            # Klient mógł się rozłączyć - zwalniamy wątek czekający na miejsce w kolejce
+            stop.set()
+            while not chunks.empty():
+                chunks.get_nowait()
+        await future
+
+
+def run_server(argv):
+    """Uruchamia tryb serwera: python app.py --serve [--host HOST] [--port PORT]"""
+    parser = argparse.ArgumentParser(description="Gemini Chat Pro - tryb serwera")
+    parser.add_argument("--serve", action="store_true")
+    parser.add_argument("--host", default=SERVER_HOST)
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    args = parser.parse_args(argv)
+    ChatServer(Path(__file__).parent, args.host, args.port).run()
+
+
+class ConversationTab:
+    """
+    Jedna otwarta konwersacja w karcie: własna historia, własny widżet czatu
+    (nie jest przebudowywany przy przełączaniu kart) i własne trwające zapytanie.
+    """
+    def __init__(self, notebook, title):
+        self.notebook = notebook
+        self.title = title
+        self.history = [] # Lista obiektów Message
+        self.preprompts = {} # Identyfikator -> treść prepromptów użytych w konwersacji
+        self.attachments = [] # Ścieżki plików dołączanych do każdej wiadomości
+        # Stan pliku przy ostatnim wczytaniu/zapisie (wykrywanie zmian z trybu serwera)
+        self.saved_mtime = None
+        self.saved_count = 0
+        self.conversation_id = None
+        self.system_prompt = None # Treść pola "Prompt systemowy" przypisana do karty
+        self.rendered_images = [] # Store references to PhotoImage objects
+        self.generating = False
+        self.dirty = False
+
+        self.frame = ttk.Frame(notebook)
+        self.chat_display = scrolledtext.ScrolledText(
+            self.frame,
+            wrap=tk.WORD,
+            font=('Arial', 11), # Changed to non-bold for general text
+            state='disabled'
+        )
+        self.chat_display.pack(fill=tk.BOTH, expand=True)
+        self.setup_tags()
+        notebook.add(self.frame, text=title)
+
+    def setup_tags(self):
+        """Konfiguracja stylów wiadomości"""
+        self.chat_display.tag_config(
+            'user_prefix', # Tag for "Ty: "
+            foreground='#0066cc',
+            font=('Arial', 11, 'bold')
+        )
+        self.chat_display.tag_config(
+            'user_text', # Tag for user's actual message
+            foreground='black', # Default text color
+            font=('Arial', 11)
+        )
+        self.chat_display.tag_config(
+            'bot_prefix', # Tag for "AI: "
+            foreground='#009933',
+            font=('Arial', 11, 'bold')
+        )
+        self.chat_display.tag_config(
+            'bot_text', # Tag for bot's actual message
+            foreground='black', # Default text color
+            font=('Arial', 11)
+        )
+        self.chat_display.tag_config(
+            'error', 
+            foreground='#cc0000',
+            font=('Arial', 11)
+        )
+
+    def set_title(self, title):
+        self.title = title
+        self.update_title()
+
+    def update_title(self):
+        """Tytuł karty: '…' gdy trwa generowanie, '*' gdy są niezapisane zmiany"""
+        text = self.title
+        if self.generating:
+            text += " …"
+        if self.dirty:
+            text += " *"
+        self.notebook.tab(self.frame, text=text)
+
+    def clear(self):
+        self.chat_display.config(state='normal')
+        self.chat_display.delete('1.0', tk.END)
+        self.chat_display.config(state='disabled')
+        self.rendered_images = [] # Clear old image references
+
+    def begin_stream(self):
+        """Zaczyna strumieniowaną odpowiedź (zwykły tekst, formuły dopiero na końcu)"""
+        self.chat_display.config(state='normal')
+        self.chat_display.mark_set('stream_start', 'end-1c')
+        self.chat_display.mark_gravity('stream_start', tk.LEFT)
+        self.chat_display.insert(tk.END, "AI: ", 'bot_prefix')
+        self.chat_display.config(state='disabled')
+        self.chat_display.see(tk.END)
+
+    def append_stream(self, text):
+        self.chat_display.config(state='normal')
+        self.chat_display.insert(tk.END, text, 'bot_text')
+        self.chat_display.config(state='disabled')
+        self.chat_display.see(tk.END)
+
+    def end_stream(self):
+        """Usuwa tymczasowy tekst strumienia, zastępowany potem pełną wiadomością"""
+        if 'stream_start' not in self.chat_display.mark_names():
+            return
+        self.chat_display.config(state='normal')
+        self.chat_display.delete('stream_start', tk.END)
+        self.chat_display.config(state='disabled')
+        self.chat_display.mark_unset('stream_start')
+
 
 class GeminiChatApp:
     def __init__(self, root):
@@ -26,16 +2616,35 @@ class GeminiChatApp:
         
         # Konfiguracja Gemini API
         self.init_gemini()
+        self.context_cache = ContextCache(self.context_cache_file)
+        
+        # Indeks zapisanych wiadomości (wczytywany przy pierwszym użyciu)
+        self.history_index = HistoryIndex(self.history_index_dir, self.conversations_dir)
+        self.uploads = FileUploads(self.uploads_file)
+        self.generation_profiles = GenerationProfiles(self.generation_profiles_file)
         
         # Inicjalizacja interfejsu
         self.setup_ui()
         
         # Zmienne stanu
-        self.conversation_history = []
-        self.current_conversation_id = None
-        self.rendered_images = [] # Store references to PhotoImage objects
+        self.latex_cache = OrderedDict() # (latex, block_mode) -> (PhotoImage, PNG)
+        self.language = DEFAULT_LANGUAGE
+        self.template_context = {
+            'language': lambda arg: self.language,
+            'date': lambda arg: datetime.now().strftime(arg or '%Y-%m-%d'),
+            'time': lambda arg: datetime.now().strftime(arg or '%H:%M'),
+            'clipboard': lambda arg: self.read_clipboard(),
+            'reply': self.previous_reply,
+        }
         self.app_data_dir = Path(__file__).parent
         
+        # Połączenie z API nawiązujemy w tle, zaraz po pokazaniu okna
+        self.root.after_idle(self.start_warm_up)
+        
+        # Wątki robocze przekazują zmiany interfejsu przez kolejkę
+        self.ui_events = queue.Queue()
+        self.process_ui_events()
+        
     def init_paths(self):
         """Inicjalizuje ścieżki do plików konfiguracyjnych"""
         self.app_data_dir = Path(__file__).parent
@@ -44,14 +2653,23 @@ class GeminiChatApp:
     
         self.preprompts_file = os.path.join(
             self.app_data_dir, 
-            "preprompts.json"
+            PREPROMPTS_JSON
+        )
+        self.preprompts_db = os.path.join(
+            self.app_data_dir, 
+            PREPROMPTS_DB
         )
         self.conversations_dir = os.path.join(
             self.app_data_dir, 
-            "conversations"
+            CONVERSATIONS_DIR
         )
         os.makedirs(self.conversations_dir, exist_ok=True)
-        self.api_key_file = os.path.join(self.app_data_dir, "api_key.txt") # Dodaj tę linię
+        self.api_key_file = os.path.join(self.app_data_dir, API_KEY_FILE) # Dodaj tę linię
+        self.compare_variants_file = os.path.join(self.app_data_dir, "compare_variants.json")
+        self.context_cache_file = os.path.join(self.app_data_dir, CONTEXT_CACHE_FILE)
+        self.history_index_dir = os.path.join(self.app_data_dir, HISTORY_INDEX_DIR)
+        self.uploads_file = os.path.join(self.app_data_dir, UPLOADS_FILE)
+        self.generation_profiles_file = os.path.join(self.app_data_dir, GENERATION_PROFILES_FILE)
             
         
 
@@ -65,15 +2683,14 @@ class GeminiChatApp:
                 with open(self.api_key_file, "r") as f:
                     api_key = f.read().strip()
             except FileNotFoundError:
-                full_path = os.path.join(self.app_data_dir, "api_key.txt")
+                full_path = os.path.join(self.app_data_dir, API_KEY_FILE)
                 api_key = simpledialog.askstring(
                     "Zapisz klucz API",
                     "Podaj klucz API:"
                 )
                 f = open(full_path, "a")
                 f.write(api_key)
-            genai.configure(api_key=api_key) 
-            self.model = genai.GenerativeModel("gemini-2.5-flash") # Updated model to 1.5-flash
+            self.client = GeminiClient(api_key)
         except Exception as e:
             messagebox.showerror(
                 "Błąd inicjalizacji", 
@@ -81,6 +2698,29 @@ class GeminiChatApp:
             )
             raise
 
+    @property
+    def model(self):
+        return self.client.model(DEFAULT_MODEL_NAME)
+
+    def get_model(self, model_name):
+        """Zwraca (współdzielony) obiekt modelu o podanej nazwie"""
+        return self.client.model(model_name)
+
+    def start_warm_up(self):
+        """Rozgrzewa połączenie w tle, gdy okno jest już widoczne"""
+        if os.environ.get(GEMINI_NO_WARMUP_ENV):
+            return
+
+        def worker():
+            elapsed = self.client.warm_up()
+            if elapsed is not None:
+                self.call_in_ui(
+                    self.status_var.set,
+                    f"Gotowy (połączenie nawiązane w {elapsed:.2f} s)"
+                )
+
+        Thread(target=worker, daemon=True).start()
+
     def setup_ui(self):
         """Konfiguruje cały interfejs użytkownika"""
         self.setup_menu()
@@ -92,6 +2732,15 @@ class GeminiChatApp:
         # Ładowanie danych
         self.load_preprompts()
         self.load_conversation_list()
+        
+        # Biblioteka prepromptów może być zmieniana przez tryb serwera
+        self.root.bind("<FocusIn>", self.on_focus_in, add='+')
+
+    def on_focus_in(self, event):
+        """Odświeża preprompty, jeśli zmienił je inny proces"""
+        if self.preprompt_store.refresh_if_changed():
+            self.composed_templates = {}
+            self.refresh_preprompt_list()
 
     def setup_menu(self):
         """Konfiguruje menu główne"""
@@ -110,8 +2759,21 @@ class GeminiChatApp:
             accelerator="Ctrl+S"
         )
         file_menu.add_command(
-            label="Eksportuj jako...", 
-            command=self.export_conversation
+            label="Zamknij kartę", 
+            command=self.close_current_tab,
+            accelerator="Ctrl+W"
+        )
+        file_menu.add_command(
+            label="Eksportuj jako...", 
+            command=self.export_conversation
+        )
+        file_menu.add_command(
+            label="Eksportuj wszystkie...", 
+            command=self.export_all_conversations
+        )
+        file_menu.add_command(
+            label="Porównaj modele...", 
+            command=self.show_compare_window
         )
         file_menu.add_separator()
         file_menu.add_command(
@@ -146,6 +2808,10 @@ class GeminiChatApp:
             label="Zmień klucz API", 
             command=self.zmien_api_key
         )
+        edit_menu.add_command(
+            label="Profile generowania...", 
+            command=lambda: GenerationProfilesWindow(self)
+        )
         menubar.add_cascade(label="Edycja", menu=edit_menu)
         
         
@@ -154,6 +2820,7 @@ class GeminiChatApp:
         # Skróty klawiaturowe
         self.root.bind("<Control-n>", lambda e: self.new_conversation())
         self.root.bind("<Control-s>", lambda e: self.save_conversation())
+        self.root.bind("<Control-w>", lambda e: self.close_current_tab())
 
 
     def zmien_api_key(self):
@@ -161,13 +2828,19 @@ class GeminiChatApp:
             "Zapisz klucz API",
             "Podaj klucz API:"
         )
+        if not api_key:
+            return
         with open(self.api_key_file, "w") as f:
             f.write(api_key)
         messagebox.showinfo(
             "Sukces",
             "Klucz API został zapisany."
         )
-        self.init_gemini()
+        # Cache kontekstu należy do projektu starego klucza
+        self.context_cache.clear()
+        # Klient jest konfigurowany w miejscu - trwające zapytania kończą się normalnie
+        self.client.configure(api_key.strip())
+        self.start_warm_up()
     
     def show_about(self):
         messagebox.showinfo(
@@ -231,6 +2904,18 @@ class GeminiChatApp:
         )
         preprompt_frame.pack(fill=tk.BOTH, expand=True)
         
+        # Filtr prepromptów (wyszukiwanie rozmyte w trakcie pisania)
+        self.preprompt_filter = tk.StringVar()
+        self.preprompt_filter_job = None
+        self.preprompt_filter.trace_add(
+            "write", 
+            lambda *args: self.schedule_preprompt_filter()
+        )
+        ttk.Entry(
+            preprompt_frame,
+            textvariable=self.preprompt_filter
+        ).pack(fill=tk.X, pady=(0, 5))
+        
         self.preprompt_listbox = tk.Listbox(
             preprompt_frame,
             height=10
@@ -281,48 +2966,24 @@ class GeminiChatApp:
             "Jesteś pomocnym asystentem. Odpowiadaj w języku polskim."
         )
         
-        # Główny obszar czatu
-        self.chat_display = scrolledtext.ScrolledText(
-            self.right_panel,
-            wrap=tk.WORD,
-            font=('Arial', 11), # Changed to non-bold for general text
-            state='disabled'
-        )
-        self.chat_display.pack(fill=tk.BOTH, expand=True)
-        
-        # Konfiguracja stylów wiadomości
-        self.chat_display.tag_config(
-            'user_prefix', # Tag for "Ty: "
-            foreground='#0066cc',
-            font=('Arial', 11, 'bold')
-        )
-        self.chat_display.tag_config(
-            'user_text', # Tag for user's actual message
-            foreground='black', # Default text color
-            font=('Arial', 11)
-        )
-        self.chat_display.tag_config(
-            'bot_prefix', # Tag for "AI: "
-            foreground='#009933',
-            font=('Arial', 11, 'bold')
-        )
-        self.chat_display.tag_config(
-            'bot_text', # Tag for bot's actual message
-            foreground='black', # Default text color
-            font=('Arial', 11)
-        )
-        self.chat_display.tag_config(
-            'error', 
-            foreground='#cc0000',
-            font=('Arial', 11)
-        )
+        # Główny obszar czatu - każda otwarta konwersacja ma własną kartę
+        self.notebook = ttk.Notebook(self.right_panel)
+        self.notebook.pack(fill=tk.BOTH, expand=True)
+        self.tabs = {} # nazwa widżetu karty -> ConversationTab
+        self.active_tab = None
+        self.attachments_var = tk.StringVar() # Załączniki bieżącej karty
+        self.notebook.bind("<<NotebookTabChanged>>", self.on_tab_changed)
+        self.open_tab()
         
         # Dolny panel - wprowadzanie wiadomości
         input_frame = ttk.Frame(self.right_panel)
         input_frame.pack(fill=tk.X, pady=(10, 0))
         
-        self.user_input = ttk.Entry(
+        # Wieloliniowe pole: Enter wysyła, Shift+Enter dodaje nową linię
+        self.user_input = scrolledtext.ScrolledText(
             input_frame,
+            wrap=tk.WORD,
+            height=4,
             font=('Arial', 11)
         )
         self.user_input.pack(
@@ -331,16 +2992,44 @@ class GeminiChatApp:
             expand=True, 
             padx=(0, 5)
         )
-        self.user_input.bind(
-            "<Return>", 
-            lambda e: self.send_message()
-        )
+        self.user_input.bind("<Return>", self.on_input_return)
+        
+        buttons_frame = ttk.Frame(input_frame)
+        buttons_frame.pack(side=tk.RIGHT, fill=tk.Y)
         
         ttk.Button(
-            input_frame,
+            buttons_frame,
             text="Wyślij",
             command=self.send_message
+        ).pack(fill=tk.X)
+        
+        ttk.Button(
+            buttons_frame,
+            text="Załącz plik...",
+            command=self.add_attachments
+        ).pack(fill=tk.X, pady=(5, 0))
+        
+        # Dołączanie do pytania podobnych fragmentów zapisanych rozmów
+        self.attach_history = tk.BooleanVar(value=False)
+        ttk.Checkbutton(
+            buttons_frame,
+            text="Dołącz pasującą historię",
+            variable=self.attach_history
+        ).pack(fill=tk.X, pady=(5, 0))
+        
+        # Załączniki karty - wysyłane z każdą kolejną wiadomością, aż do usunięcia
+        attachments_frame = ttk.Frame(self.right_panel)
+        attachments_frame.pack(fill=tk.X, pady=(5, 0))
+        ttk.Label(
+            attachments_frame,
+            textvariable=self.attachments_var
+        ).pack(side=tk.LEFT, fill=tk.X, expand=True)
+        ttk.Button(
+            attachments_frame,
+            text="Usuń załączniki",
+            command=self.clear_attachments
         ).pack(side=tk.RIGHT)
+        self.update_attachments_label()
 
     def setup_status_bar(self):
         """Konfiguruje pasek statusu"""
@@ -357,41 +3046,79 @@ class GeminiChatApp:
 
     # === Metody zarządzania prepromptami ===
     def load_preprompts(self):
-        """Wczytuje preprompty z pliku"""
-        self.preprompts = {}
+        """Otwiera bibliotekę prepromptów i wypełnia listę"""
+        # Złożone szablony zależą od całej biblioteki, więc po zmianie ją czyścimy
+        self.composed_templates = {}
         try:
-            if os.path.exists(self.preprompts_file):
-                with open(self.preprompts_file, 'r', encoding='utf-8') as f:
-                    self.preprompts = json.load(f)
+            self.preprompt_store = PrepromptStore(
+                self.preprompts_db,
+                legacy_json=self.preprompts_file
+            )
         except Exception as e:
             messagebox.showwarning(
                 "Ostrzeżenie",
                 f"Nie można wczytać prepromptów:\n{str(e)}"
             )
+            self.preprompt_store = PrepromptStore(":memory:")
         
-        # Aktualizacja listy
+        self.refresh_preprompt_list()
+
+    def refresh_preprompt_list(self):
+        """Wypełnia listę prepromptów zgodnie z bieżącym filtrem"""
+        names = self.preprompt_store.search(self.preprompt_filter.get())
         self.preprompt_listbox.delete(0, tk.END)
-        for name in sorted(self.preprompts.keys()):
-            self.preprompt_listbox.insert(tk.END, name)
-
-    def save_preprompts(self):
-        """Zapisuje preprompty do pliku"""
-        try:
-            with open(self.preprompts_file, 'w', encoding='utf-8') as f:
-                json.dump(
-                    self.preprompts, 
-                    f, 
-                    indent=2, 
-                    ensure_ascii=False
-                )
-            return True
-        except Exception as e:
+        if names:
+            self.preprompt_listbox.insert(tk.END, *names)
+
+    def schedule_preprompt_filter(self):
+        """Odświeża filtr z krótkim opóźnieniem, żeby nie filtrować przy każdym klawiszu"""
+        if self.preprompt_filter_job is not None:
+            self.root.after_cancel(self.preprompt_filter_job)
+        self.preprompt_filter_job = self.root.after(
+            120, 
+            self.apply_preprompt_filter
+        )
+
+    def apply_preprompt_filter(self):
+        self.preprompt_filter_job = None
+        self.refresh_preprompt_list()
+
+    def save_preprompt(self, name, content):
+        """Zapisuje jeden preprompt i aktualizuje listę bez jej przebudowy"""
+        try:
+            position = self.preprompt_store.put(name, content)
+        except sqlite3.Error as e:
             messagebox.showerror(
                 "Błąd",
                 f"Nie można zapisać prepromptów:\n{str(e)}"
             )
             return False
 
+        self.composed_templates = {}
+        if self.preprompt_filter.get().strip():
+            self.refresh_preprompt_list()
+        elif position is not None:
+            self.preprompt_listbox.insert(position, name)
+        return True
+
+    def remove_preprompt(self, name):
+        """Usuwa jeden preprompt i jego pozycję z listy"""
+        try:
+            position = self.preprompt_store.delete(name)
+        except sqlite3.Error as e:
+            messagebox.showerror(
+                "Błąd",
+                f"Nie można usunąć prepromptu:\n{str(e)}"
+            )
+            return False
+
+        self.composed_templates = {}
+        if self.preprompt_filter.get().strip():
+            self.refresh_preprompt_list()
+        elif position is not None:
+            self.preprompt_listbox.delete(position)
+        return True
+
     def save_current_preprompt(self):
         """Zapisuje bieżący prompt jako nowy preprompt"""
         current_prompt = self.system_prompt.get().strip()
@@ -408,16 +3135,16 @@ class GeminiChatApp:
         )
         
         if name:
-            if name in self.preprompts:
+            if not self.validate_preprompt(current_prompt, name):
+                return
+            if name in self.preprompt_store:
                 if not messagebox.askyesno(
                     "Potwierdzenie",
                     f"Preprompt '{name}' już istnieje. Nadpisać?"
                 ):
                     return
                     
-            self.preprompts[name] = current_prompt
-            if self.save_preprompts():
-                self.load_preprompts()
+            if self.save_preprompt(name, current_prompt):
                 messagebox.showinfo(
                     "Sukces",
                     f"Zapisano preprompt '{name}'"
@@ -428,7 +3155,8 @@ class GeminiChatApp:
         selection = self.preprompt_listbox.curselection()
         if selection:
             selected_name = self.preprompt_listbox.get(selection[0])
-            selected_prompt = self.preprompts.get(selected_name, "")
+            # Treść jest wczytywana z bazy dopiero przy wyborze
+            selected_prompt = self.preprompt_store.get(selected_name, "")
             self.system_prompt.delete(0, tk.END)
             self.system_prompt.insert(0, selected_prompt)
 
@@ -449,9 +3177,7 @@ class GeminiChatApp:
             "Potwierdzenie",
             f"Czy na pewno chcesz usunąć preprompt '{selected_name}'?"
         ):
-            del self.preprompts[selected_name]
-            if self.save_preprompts():
-                self.load_preprompts()
+            self.remove_preprompt(selected_name)
 
     def show_preprompts_manager(self):
         """Pokazuje zaawansowane okno zarządzania prepromptami"""
@@ -509,6 +3235,14 @@ class GeminiChatApp:
                 "Prompt systemowy jest pusty!"
             )
             return
+
+        name = None
+        if not new:
+            selection = self.preprompt_listbox.curselection()
+            if selection:
+                name = self.preprompt_listbox.get(selection[0])
+        if not self.validate_preprompt(content, name):
+            return
             
         if new:
             self.save_custom_preprompt(content, window)
@@ -526,15 +3260,59 @@ class GeminiChatApp:
             return
             
         selected_name = self.preprompt_listbox.get(selection[0])
-        self.preprompts[selected_name] = content
-        if self.save_preprompts():
-            self.load_preprompts()
+        if self.save_preprompt(selected_name, content):
             window.destroy()
             messagebox.showinfo(
                 "Sukces",
                 f"Zaktualizowano preprompt '{selected_name}'"
             )
 
+    # === Szablony prepromptów ===
+    def compile_preprompt(self, source):
+        """Kompiluje preprompt razem z dołączonymi prepromptami (wynik jest cache'owany)"""
+        key = PrepromptTemplate.content_hash(source)
+        template = self.composed_templates.get(key)
+        if template is None:
+            template = PrepromptTemplate.compile(source).compose(self.preprompt_store.get)
+            self.composed_templates[key] = template
+        return template
+
+    def render_preprompt(self, source):
+        """Zwraca treść prepromptu z podstawionymi zmiennymi"""
+        return self.compile_preprompt(source).render(self.template_context)
+
+    def validate_preprompt(self, content, name=None):
+        """Sprawdza szablon przed zapisem, pokazuje ostrzeżenie w razie błędu"""
+        def resolve(other):
+            return content if other == name else self.preprompt_store.get(other)
+
+        try:
+            stack = (name,) if name else ()
+            PrepromptTemplate.compile(content).compose(resolve, stack)
+        except PrepromptTemplateError as e:
+            messagebox.showwarning(
+                "Błąd szablonu",
+                f"Preprompt zawiera błąd:\n{str(e)}"
+            )
+            return False
+        return True
+
+    def read_clipboard(self):
+        """Zwraca zawartość schowka lub pusty tekst"""
+        try:
+            return self.root.clipboard_get()
+        except tk.TclError:
+            return ""
+
+    def previous_reply(self, n=1):
+        """Zwraca n-tą od końca odpowiedź modelu"""
+        for role, msg in reversed(self.conversation_history):
+            if role == 'bot':
+                n -= 1
+                if n <= 0:
+                    return msg
+        return ""
+
     # === Metody zarządzania konwersacjami ===
     def load_conversation_list(self):
         """Wczytuje listę zapisanych konwersacji"""
@@ -557,22 +3335,110 @@ class GeminiChatApp:
             self.conversation_listbox.insert(tk.END, conv)
 
     def new_conversation(self):
-        """Rozpoczyna nową konwersację"""
-        if (self.conversation_history and 
-            not messagebox.askyesno(
-                "Potwierdzenie",
-                "Czy na pewno chcesz rozpocząć nową konwersację?\nNie zapisane dane zostaną utracone."
-            )):
-            return
-            
-        self.conversation_history = []
-        self.current_conversation_id = None
-        self.chat_display.config(state='normal')
-        self.chat_display.delete('1.0', tk.END)
-        self.chat_display.config(state='disabled')
+        """Rozpoczyna nową konwersację w nowej karcie"""
+        self.open_tab()
         self.status_var.set("Nowa konwersacja - niezapisana")
-        # Clear image references for new conversation
-        self.rendered_images = [] 
+
+    # === Karty konwersacji ===
+    def open_tab(self, title="Nowa konwersacja"):
+        """Otwiera nową kartę i przełącza się na nią"""
+        tab = ConversationTab(self.notebook, title)
+        self.tabs[str(tab.frame)] = tab
+        self.notebook.select(tab.frame)
+        # Zdarzenie zmiany karty przychodzi asynchronicznie, a wywołujący
+        # może od razu zmienić pole promptu - przełączamy stan od razu
+        self.on_tab_changed(None)
+        return tab
+
+    @property
+    def current_tab(self):
+        return self.tabs[self.notebook.select()]
+
+    @property
+    def conversation_history(self):
+        return self.current_tab.history
+
+    @conversation_history.setter
+    def conversation_history(self, history):
+        self.current_tab.history = history
+
+    @property
+    def current_conversation_id(self):
+        return self.current_tab.conversation_id
+
+    @current_conversation_id.setter
+    def current_conversation_id(self, conversation_id):
+        self.current_tab.conversation_id = conversation_id
+
+    def find_tab(self, conversation_id):
+        for tab in self.tabs.values():
+            if tab.conversation_id == conversation_id:
+                return tab
+        return None
+
+    def on_tab_changed(self, event):
+        """
+        Przełączenie karty: widżety kart żyją cały czas, więc wystarczy
+        zamienić treść pola promptu systemowego
+        """
+        tab = self.current_tab
+        if tab is self.active_tab:
+            return
+        if self.active_tab is not None and str(self.active_tab.frame) in self.tabs:
+            self.active_tab.system_prompt = self.system_prompt.get()
+        if tab.system_prompt is not None:
+            self.system_prompt.delete(0, tk.END)
+            self.system_prompt.insert(0, tab.system_prompt)
+        self.active_tab = tab
+        self.update_attachments_label()
+
+    def close_current_tab(self):
+        """Zamyka bieżącą kartę (ostatnia karta jest zastępowana pustą)"""
+        tab = self.current_tab
+        if tab.generating and not messagebox.askyesno(
+            "Potwierdzenie",
+            "W tej karcie trwa generowanie odpowiedzi. Zamknąć mimo to?"
+        ):
+            return
+        if tab.dirty and not messagebox.askyesno(
+            "Potwierdzenie",
+            "Czy na pewno chcesz zamknąć tę konwersację?\nNie zapisane dane zostaną utracone."
+        ):
+            return
+
+        del self.tabs[str(tab.frame)]
+        if self.active_tab is tab:
+            self.active_tab = None
+        if not self.tabs:
+            self.open_tab()
+        self.notebook.forget(tab.frame)
+        tab.frame.destroy()
+
+    def call_in_ui(self, func, *args):
+        """Zleca wykonanie funkcji w wątku Tk (bezpieczne z wątków roboczych)"""
+        self.ui_events.put((func, args))
+
+    def call_in_tab(self, tab, func, *args):
+        """Jak call_in_ui, ale pomija wywołanie, jeśli karta została w międzyczasie zamknięta"""
+        self.call_in_ui(self.run_in_tab, tab, func, args)
+
+    def run_in_tab(self, tab, func, args):
+        if str(tab.frame) in self.tabs:
+            func(*args)
+
+    def process_ui_events(self):
+        try:
+            while True:
+                func, args = self.ui_events.get_nowait()
+                # Błąd jednego zdarzenia nie może zatrzymać obsługi kolejnych
+                try:
+                    func(*args)
+                except Exception as e:
+                    print(f"Error in UI event {getattr(func, '__name__', func)}: {e}")
+        except queue.Empty:
+            pass
+        finally:
+            self.root.after(30, self.process_ui_events)
 
     def save_custom_preprompt(self, content, window):
         """Zapisuje nowy preprompt z edytora"""
@@ -583,9 +3449,7 @@ class GeminiChatApp:
         )
         
         if name:
-            self.preprompts[name] = content
-            if self.save_preprompts():
-                self.load_preprompts()
+            if self.save_preprompt(name, content):
                 window.destroy()
                 messagebox.showinfo(
                     "Sukces",
@@ -619,18 +3483,35 @@ class GeminiChatApp:
             filename = f"conv_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
             
         filepath = os.path.join(self.conversations_dir, filename)
+        tab = self.current_tab
         
         try:
-            data = {
-                "system_prompt": self.system_prompt.get(),
-                "history": self.conversation_history,
-                "created_at": datetime.now().isoformat()
-            }
+            if (tab.saved_mtime is not None and os.path.exists(filepath)
+                    and os.stat(filepath).st_mtime_ns != tab.saved_mtime):
+                if tab.generating:
+                    self.status_var.set("Poczekaj na odpowiedź w tej karcie")
+                    return False
+                self.merge_conversation_file(tab, filepath)
+
+            data = conversation_to_data(
+                self.conversation_history,
+                self.current_tab.preprompts,
+                self.system_prompt.get()
+            )
             
-            with open(filepath, 'w', encoding='utf-8') as f:
-                json.dump(data, f, indent=2, ensure_ascii=False)
+            write_json_atomic(filepath, data, compact=True)
+            tab.saved_mtime = os.stat(filepath).st_mtime_ns
+            tab.saved_count = len(tab.history)
                 
             self.current_conversation_id = os.path.splitext(filename)[0]
+            Thread(
+                target=self.history_index.update,
+                args=(self.current_conversation_id, list(self.conversation_history)),
+                daemon=True
+            ).start()
+            self.save_formula_bundle(filepath, self.conversation_history)
+            self.current_tab.dirty = False
+            self.current_tab.set_title(self.current_conversation_id)
             self.load_conversation_list()
             self.status_var.set(f"Konwersacja zapisana: {self.current_conversation_id}")
             return True
@@ -642,6 +3523,18 @@ class GeminiChatApp:
             )
             return False
 
+    def merge_conversation_file(self, tab, filepath):
+        """
+        Plik konwersacji zmienił się od wczytania (np. tryb serwera dopisał wiadomości):
+        zamiast go nadpisać, dokładamy do jego treści wiadomości dodane w karcie.
+        """
+        with open(filepath, 'r', encoding='utf-8') as f:
+            messages, preprompts = load_conversation_data(json.load(f))
+        tab.history = messages + tab.history[tab.saved_count:]
+        tab.preprompts = {**preprompts, **tab.preprompts}
+        tab.clear()
+        self.display_messages(tab.history, tab)
+
     def load_selected_conversation(self):
         """Wczytuje wybraną konwersację z listy"""
         selection = self.conversation_listbox.curselection()
@@ -654,36 +3547,36 @@ class GeminiChatApp:
             f"{conv_name}.json"
         )
         
+        # Konwersacja otwarta już w karcie - wystarczy ją pokazać
+        tab = self.find_tab(conv_name)
+        if tab is not None:
+            self.notebook.select(tab.frame)
+            return
+        
         try:
             with open(filepath, 'r', encoding='utf-8') as f:
                 data = json.load(f)
                 
-            # Potwierdzenie przed nadpisaniem
-            if (self.conversation_history and 
-                not messagebox.askyesno(
-                    "Potwierdzenie",
-                    "Czy na pewno chcesz wczytać tę konwersację?\nNie zapisane dane zostaną utracone."
-                )):
-                return
+            # Pusta bieżąca karta jest używana ponownie, w innym wypadku otwieramy nową
+            tab = self.current_tab
+            if tab.history or tab.generating:
+                tab = self.open_tab(conv_name)
+            else:
+                tab.set_title(conv_name)
+                tab.clear()
                 
             # Wczytanie danych
             self.system_prompt.delete(0, tk.END)
             self.system_prompt.insert(0, data.get("system_prompt", ""))
             
-            self.conversation_history = data.get("history", [])
-            self.current_conversation_id = conv_name
-            
-            # Wyświetlenie historii
-            self.chat_display.config(state='normal')
-            self.chat_display.delete('1.0', tk.END)
-            self.rendered_images = [] # Clear old image references
+            tab.history, tab.preprompts = load_conversation_data(data)
+            tab.conversation_id = conv_name
+            tab.saved_mtime = os.stat(filepath).st_mtime_ns
+            tab.saved_count = len(tab.history)
+            self.preload_formula_bundle(filepath, tab.history)
             
-            for role, msg in self.conversation_history:
-                # Use display_message to handle potential LaTeX in loaded history
-                self.display_message(role, msg, is_new_entry=False) 
-                
-            self.chat_display.config(state='disabled')
-            self.chat_display.see(tk.END)
+            # Cała historia trafia do widżetu jedną partią
+            self.display_messages(tab.history, tab)
             
             self.status_var.set(f"Wczytano konwersację: {conv_name}")
             
@@ -693,6 +3586,51 @@ class GeminiChatApp:
                 f"Nie można wczytać konwersacji:\n{str(e)}"
             )
 
+    def save_formula_bundle(self, filepath, history):
+        """
+        Zapisuje w tle obok konwersacji paczkę PNG jej formuł, żeby po ponownym
+        otwarciu nie renderować ich od nowa. Obrazki pochodzą z pamięci podręcznej
+        okna; formuły, które z niej już wypadły, są przepisywane z poprzedniej paczki.
+        """
+        pngs = {}
+        for formula in conversation_formulas(history):
+            cached = self.latex_cache.get(formula)
+            pngs[formula_key(*formula)] = cached[1] if cached else None
+        bundle_path = formula_bundle_path(filepath)
+
+        def worker():
+            try:
+                if None in pngs.values():
+                    previous = read_formula_bundle(bundle_path)
+                    for key, png in pngs.items():
+                        if png is None:
+                            pngs[key] = previous.get(key)
+                available = {key: png for key, png in pngs.items() if png is not None}
+                if available:
+                    write_formula_bundle(bundle_path, available)
+                elif os.path.exists(bundle_path):
+                    os.remove(bundle_path)
+            except OSError as e:
+                print(f"Nie można zapisać paczki formuł: {e}")
+
+        Thread(target=worker, daemon=True).start()
+
+    def preload_formula_bundle(self, filepath, history):
+        """Wstawia do pamięci podręcznej formuły z paczki zapisanej obok konwersacji"""
+        bundle = read_formula_bundle(formula_bundle_path(filepath))
+        if not bundle:
+            return
+        for formula in conversation_formulas(history):
+            png = bundle.get(formula_key(*formula))
+            if png is None or formula in self.latex_cache:
+                continue
+            try:
+                tk_image = ImageTk.PhotoImage(Image.open(io.BytesIO(png)))
+            except Exception as e:
+                print(f"Error loading bundled formula: {e}")
+                continue
+            self.cache_formula_image(formula, tk_image, bytes(png))
+
     def on_conversation_select(self, event):
         """Obsługuje wybór konwersacji z listy"""
         selection = self.conversation_listbox.curselection()
@@ -719,6 +3657,9 @@ class GeminiChatApp:
             
             try:
                 os.remove(filepath)
+                if os.path.exists(formula_bundle_path(filepath)):
+                    os.remove(formula_bundle_path(filepath))
+                Thread(target=self.history_index.remove, args=(conv_name,), daemon=True).start()
                 self.load_conversation_list()
                 messagebox.showinfo(
                     "Sukces",
@@ -731,7 +3672,7 @@ class GeminiChatApp:
                 )
 
     def export_conversation(self):
-        """Eksportuje konwersację do pliku tekstowego"""
+        """Eksportuje konwersację do pliku tekstowego, Markdown lub HTML"""
         if not self.conversation_history:
             messagebox.showwarning(
                 "Pusta konwersacja",
@@ -749,77 +3690,282 @@ class GeminiChatApp:
             filetypes=[
                 ("Plik tekstowy", "*.txt"),
                 ("Plik Markdown", "*.md"),
+                ("Strona HTML", "*.html"),
                 ("Wszystkie pliki", "*.*")
             ],
             initialfile=default_name
         )
         
         if filepath:
-            try:
-                with open(filepath, 'w', encoding='utf-8') as f:
-                    # Nagłówek
-                    f.write(f"=== Konwersacja Gemini Chat ===\n")
-                    f.write(f"Data: {datetime.now().strftime('%Y-%m-%d %H:%M')}\n")
-                    f.write(f"Prompt systemowy: {self.system_prompt.get()}\n\n")
-                    
-                    # Historia
-                    for role, msg in self.conversation_history:
-                        prefix = "UŻYTKOWNIK: " if role == "user" else "ASYSTENT: "
-                        f.write(f"{prefix}{msg}\n\n")
-                
-                messagebox.showinfo(
-                    "Sukces",
-                    f"Konwersacja zapisana do:\n{filepath}"
-                )
-                return True
-                
-            except Exception as e:
+            self.status_var.set("Eksportowanie...")
+            Thread(
+                target=self.run_export,
+                args=(filepath, self.system_prompt.get(), list(self.conversation_history)),
+                daemon=True
+            ).start()
+
+    def run_export(self, filepath, system_prompt, history):
+        """Eksport w tle; formuły bez gotowych obrazków renderuje pula procesów"""
+        def png_lookup(formula):
+            cached = self.latex_cache.get(formula)
+            return cached[1] if cached else None
+
+        try:
+            ConversationExporter(
+                filepath, 
+                system_prompt, 
+                png_lookup=png_lookup, 
+                pool_factory=export_process_pool
+            ).export(history)
+        except Exception as e:
+            self.call_in_ui(
+                messagebox.showerror,
+                "Błąd",
+                f"Nie można zapisać pliku:\n{str(e)}"
+            )
+            self.call_in_ui(self.status_var.set, "Eksport nieudany")
+            return
+        
+        self.call_in_ui(
+            messagebox.showinfo,
+            "Sukces",
+            f"Konwersacja zapisana do:\n{filepath}"
+        )
+        self.call_in_ui(self.status_var.set, "Eksport zakończony")
+
+    def export_all_conversations(self):
+        """Eksportuje wszystkie zapisane konwersacje równolegle, z paskiem postępu"""
+        paths = [
+            os.path.join(self.conversations_dir, filename)
+            for filename in sorted(os.listdir(self.conversations_dir))
+            if filename.endswith('.json')
+        ]
+        if not paths:
+            messagebox.showwarning(
+                "Brak konwersacji",
+                "Nie ma nic do eksportowania!"
+            )
+            return
+        out_dir = filedialog.askdirectory(title="Wybierz folder eksportu")
+        if not out_dir:
+            return
+        as_html = messagebox.askyesno(
+            "Format eksportu",
+            "Eksportować do HTML?\n(Nie = Markdown)"
+        )
+        extension = ".html" if as_html else ".md"
+
+        window = tk.Toplevel(self.root)
+        window.title("Eksport konwersacji")
+        window.geometry("400x100")
+        progress = ttk.Progressbar(window, maximum=len(paths), mode='determinate')
+        progress.pack(fill=tk.X, padx=10, pady=(15, 5))
+        label_var = tk.StringVar(value=f"0 / {len(paths)}")
+        ttk.Label(window, textvariable=label_var).pack()
+
+        events = queue.Queue()
+        cancelled = Event()
+
+        def worker():
+            with export_process_pool() as pool:
+                futures = [
+                    pool.submit(export_conversation_file, path, out_dir, extension)
+                    for path in paths
+                ]
+                for future in as_completed(futures):
+                    if cancelled.is_set():
+                        # Okno postępu zamknięte - nie zaczynamy kolejnych eksportów
+                        for pending in futures:
+                            pending.cancel()
+                        return
+                    try:
+                        future.result()
+                        events.put(None)
+                    except Exception as e:
+                        events.put(str(e))
+
+        errors = []
+
+        def poll():
+            if not window.winfo_exists():
+                cancelled.set()
+                return
+            while True:
+                try:
+                    error = events.get_nowait()
+                except queue.Empty:
+                    break
+                if error:
+                    errors.append(error)
+                progress['value'] += 1
+                label_var.set(f"{int(progress['value'])} / {len(paths)}")
+            if progress['value'] < len(paths):
+                window.after(100, poll)
+                return
+            window.destroy()
+            if errors:
                 messagebox.showerror(
                     "Błąd",
-                    f"Nie można zapisać pliku:\n{str(e)}"
+                    f"Nie udało się wyeksportować {len(errors)} konwersacji:\n" 
+                    + "\n".join(errors[:5])
+                )
+            else:
+                messagebox.showinfo(
+                    "Sukces",
+                    f"Wyeksportowano {len(paths)} konwersacji do:\n{out_dir}"
                 )
-                return False
+
+        Thread(target=worker, daemon=True).start()
+        window.after(100, poll)
 
     # === Metody obsługi czatu ===
+    def on_input_return(self, event):
+        """Enter wysyła wiadomość, Shift+Enter wstawia nową linię"""
+        if event.state & 0x1:
+            return None
+        self.send_message()
+        return "break"
+
+    def add_attachments(self):
+        """Dołącza pliki do bieżącej karty"""
+        paths = filedialog.askopenfilenames(
+            title="Załącz pliki",
+            filetypes=ATTACHMENT_FILETYPES
+        )
+        tab = self.current_tab
+        rejected = []
+        for path in paths:
+            if attachment_mime_type(path) is None:
+                rejected.append(os.path.basename(path))
+            elif path not in tab.attachments:
+                tab.attachments.append(path)
+        self.update_attachments_label()
+        if rejected:
+            messagebox.showwarning(
+                "Nieobsługiwany typ pliku",
+                "Tych plików nie można załączyć (nieznany lub nieobsługiwany typ):\n"
+                + "\n".join(rejected)
+            )
+
+    def clear_attachments(self):
+        self.current_tab.attachments = []
+        self.update_attachments_label()
+
+    def update_attachments_label(self):
+        attachments = self.current_tab.attachments if self.tabs else []
+        if attachments:
+            names = ", ".join(os.path.basename(path) for path in attachments)
+            self.attachments_var.set(f"Załączniki: {names}")
+        else:
+            self.attachments_var.set("Brak załączników")
+
     def send_message(self):
         """Wysyła wiadomość do Gemini API"""
-        user_text = self.user_input.get().strip()
+        user_text = self.user_input.get('1.0', tk.END).strip()
         if not user_text:
             return
         
+        source = self.system_prompt.get().strip()
+        try:
+            preprompt = self.render_preprompt(source)
+        except PrepromptTemplateError as e:
+            messagebox.showwarning(
+                "Błąd szablonu",
+                f"Nie można użyć prepromptu:\n{str(e)}"
+            )
+            return
+
+        tab = self.current_tab
+        if tab.generating:
+            self.status_var.set("Poczekaj na odpowiedź w tej karcie")
+            return
+
+        # Ustawienia generowania zależą od prepromptu (profil)
+        profile_key, generation_config = self.generation_profiles.config_for(source)
+        # Cache kontekstu tylko dla prepromptów bez zmiennych
+        cacheable = self.compile_preprompt(source).is_static
+
         # Display user message first without preprompt in display
         self.display_message('user', user_text, is_new_entry=True) 
-        self.user_input.delete(0, tk.END)
-        
-        # Combine preprompt and user message for the API call
-        full_message_for_api = self.system_prompt.get().strip() + " " + user_text 
+        self.user_input.delete('1.0', tk.END)
+        tab.generating = True
+        tab.dirty = True
+        tab.update_title()
         
-        # Uruchomienie zapytania w tle
+        # Uruchomienie zapytania w tle - odpowiedź trafi do tej karty,
+        # nawet jeśli użytkownik przełączy się na inną
         Thread(
             target=self.process_ai_response,
-            args=(full_message_for_api,),
+            args=(
+                tab, preprompt, user_text, self.attach_history.get(), list(tab.attachments),
+                profile_key, generation_config, cacheable, source
+            ),
             daemon=True
         ).start()
 
-    def process_ai_response(self, message):
-        self.status_var.set("Łączenie z Gemini API...")
-        
-        try:
-            response = self.model.generate_content(
-                contents=message,
-                generation_config={
-                    "temperature": 0.7,
-                    "top_p": 0.9,
-                    "top_k": 40,
-                    "max_output_tokens": 2048 # A more reasonable default for text generation
-                },
-                safety_settings={
-                    "HARASSMENT": "BLOCK_NONE",
-                    "HATE_SPEECH": "BLOCK_NONE",
-                    "SEXUAL": "BLOCK_NONE",
-                    "DANGEROUS": "BLOCK_NONE"
-                }
+    def generate(self, preprompt, user_text, stream=False, attachments=(),
+                 generation_config=GENERATION_CONFIG, cacheable=True):
+        """
+        Wysyła zapytanie, korzystając z cache'u kontekstu dla długich prepromptów.
+        Zwraca (odpowiedź, czy_użyto_cache).
+        """
+        return generate_reply(
+            self.client, self.context_cache, preprompt, user_text,
+            stream=stream, attachments=attachments, generation_config=generation_config,
+            cacheable=cacheable
+        )
+
+    def show_compare_window(self):
+        """Wysyła bieżącą wiadomość równolegle do kilku wariantów modelu"""
+        user_text = self.user_input.get('1.0', tk.END).strip()
+        if not user_text:
+            messagebox.showwarning(
+                "Puste pole",
+                "Wpisz wiadomość do porównania!"
+            )
+            return
+        try:
+            preprompt = self.render_preprompt(self.system_prompt.get().strip())
+        except PrepromptTemplateError as e:
+            messagebox.showwarning(
+                "Błąd szablonu",
+                f"Nie można użyć prepromptu:\n{str(e)}"
             )
+            return
+
+        CompareWindow(self, preprompt + " " + user_text)
+
+    def process_ai_response(self, tab, preprompt, user_text, attach_history=False, attachments=(),
+                            profile_key=None, generation_config=GENERATION_CONFIG, cacheable=True,
+                            source=""):
+        """
+        Pobiera odpowiedź w wątku roboczym, strumieniując ją do karty tab.
+        source to szablon prepromptu, do którego odwołuje się zapisana wiadomość.
+        """
+        try:
+            # Pliki już przesłane (ta sama treść) nie są przesyłane ponownie
+            handles = self.uploads.prepare(
+                attachments, lambda text: self.call_in_ui(self.status_var.set, text)
+            )
+
+            # Fragmenty historii trafiają tylko do zapytania, nie do zapisanej wiadomości
+            prompt = user_text
+            if attach_history:
+                self.call_in_ui(self.status_var.set, "Szukanie w historii...")
+                prompt = self.history_index.context_for(user_text) + user_text
+
+            self.call_in_ui(self.status_var.set, "Łączenie z Gemini API...")
+            start = time.perf_counter()
+            response, from_cache = self.generate(
+                preprompt, prompt, stream=True, attachments=handles,
+                generation_config=generation_config, cacheable=cacheable
+            )
+            self.client.record_request(time.perf_counter() - start)
+            self.call_in_tab(tab, tab.begin_stream)
+            for chunk in response:
+                if chunk.parts:
+                    self.call_in_tab(tab, tab.append_stream, chunk.text)
+            elapsed = time.perf_counter() - start
             
             # Rozszerzona walidacja odpowiedzi
             if not response.candidates:
@@ -835,73 +3981,172 @@ class GeminiChatApp:
             
             # Check finish reason, if applicable
             finish_reason = getattr(response.candidates[0], 'finish_reason', None)
+            finish_reason = getattr(finish_reason, 'name', finish_reason) # API zwraca enum
             if finish_reason == "MAX_TOKENS":
                 bot_reply += "\n\n[UWAGA: Odpowiedź została obcięta - osiągnięto limit tokenów]"
             elif finish_reason and finish_reason not in ["STOP", "RECITATION"]: # STOP and RECITATION are normal
                 bot_reply += f"\n\n[UWAGA: Niekompletna odpowiedź - powód: {finish_reason}]"
 
+            # Preprompt nie jest doklejany do wiadomości - wskazuje go identyfikator szablonu
+            # (wyrenderowana treść ze zmiennymi byłaby inna przy każdej wiadomości)
+            pid = preprompt_id(source) if source else None
+            usage = getattr(response, 'usage_metadata', None)
+            entries = [
+                Message(
+                    Role.USER, user_text, pid,
+                    tokens=getattr(usage, 'prompt_token_count', None),
+                    attachments=[os.path.basename(path) for path in attachments] or None
+                ),
+                Message(Role.BOT, bot_reply, tokens=getattr(usage, 'candidates_token_count', None)),
+            ]
+
+            # Pomiar dla profilu prepromptu (tryb adaptacyjny dobiera z nich limit tokenów)
+            if profile_key is not None:
+                self.generation_profiles.record(
+                    profile_key,
+                    elapsed,
+                    getattr(usage, 'candidates_token_count', 0) or 0,
+                    finish_reason == "MAX_TOKENS"
+                )
+
             # Aktualizacja historii i UI
-            self.conversation_history.append(("user", message)) # Store the full message sent to API
-            self.conversation_history.append(("bot", bot_reply))
-            
-            self.display_message('bot', bot_reply, is_new_entry=True)
-            self.status_var.set("Odpowiedź otrzymana")
+            self.call_in_ui(
+                self.finish_response,
+                tab,
+                entries,
+                f"Odpowiedź otrzymana ({elapsed:.1f} s"
+                + (", preprompt z cache kontekstu)" if from_cache else ")"),
+                source
+            )
         
         except Exception as e:
             error_msg = f"Błąd API: {str(e)}"
-            self.display_message('error', error_msg, is_new_entry=True)
-            self.status_var.set(error_msg)
             # Only append error to history if it's a new error from the bot
             # not if it's part of a loaded conversation.
-            self.conversation_history.append(("error", error_msg))
+            self.call_in_ui(self.finish_response, tab, [Message(Role.ERROR, error_msg)], error_msg)
+
+    def finish_response(self, tab, entries, status, source=""):
+        """Kończy zapytanie karty: zapisuje wpisy w historii i wyświetla ostatni z nich"""
+        if str(tab.frame) not in self.tabs:
+            return # Karta została zamknięta w trakcie generowania
+        tab.end_stream()
+        for entry in entries:
+            if entry.preprompt_id is not None:
+                tab.preprompts[entry.preprompt_id] = source
+        tab.history.extend(entries)
+        self.display_messages([entries[-1]], tab)
+        tab.generating = False
+        tab.update_title()
+        if tab is not self.current_tab:
+            status = f"{tab.title}: {status}"
+        self.status_var.set(status)
 
     def display_message(self, sender, text, is_new_entry=True):
         """
         Wyświetla wiadomość z obsługą LaTeX.
         is_new_entry: True jeśli wiadomość jest nowa (z czatu), False jeśli ładowana z historii.
         """
-        self.chat_display.config(state='normal')
+        self.display_messages([(sender, text)])
+
+    def display_messages(self, messages, tab=None):
+        """
+        Wyświetla grupę wiadomości jedną partią (domyślnie w bieżącej karcie).
+        Przełączenie stanu widżetu i przewinięcie odbywają się raz na partię,
+        a sąsiednie fragmenty tekstu trafiają do widżetu jednym wywołaniem insert.
+        """
+        tab = tab or self.current_tab
+        segments = []
+        for sender, text in messages:
+            self.build_message_segments(sender, text, segments)
 
+        tab.chat_display.config(state='normal')
+        self.insert_segments(segments, tab)
+        tab.chat_display.config(state='disabled')
+        tab.chat_display.see(tk.END)
+
+    def build_message_segments(self, sender, text, segments):
+        """
+        Dokłada do listy segments fragmenty jednej wiadomości:
+        ('text', treść, tag) albo ('image', obrazek).
+        """
         # Add sender prefix and tag
         if sender == 'user':
-            self.chat_display.insert(tk.END, "Ty: ", 'user_prefix')
+            segments.append(('text', "Ty: ", 'user_prefix'))
             message_tag = 'user_text'
         elif sender == 'bot':
-            self.chat_display.insert(tk.END, "AI: ", 'bot_prefix')
+            segments.append(('text', "AI: ", 'bot_prefix'))
             message_tag = 'bot_text'
         elif sender == 'error':
-            self.chat_display.insert(tk.END, "BŁĄD: ", 'error')
+            segments.append(('text', "BŁĄD: ", 'error'))
             message_tag = 'error'
         else: # Fallback
-            self.chat_display.insert(tk.END, f"{sender.capitalize()}: ", 'bot_prefix')
+            segments.append(('text', f"{sender.capitalize()}: ", 'bot_prefix'))
             message_tag = 'bot_text'
 
-        # Regex to split by LaTeX delimiters ($...$ for inline, $$...$$ for block)
-        # It keeps the delimiters in the result
-        parts = re.split(r'(\$\$[^$]+\$\$|\$[^$]+\$)', text)
-
-        for part in parts:
+        # Split by LaTeX delimiters ($...$ for inline, $$...$$ for block),
+        # keeping the delimiters in the result
+        for part in LATEX_PATTERN.split(text):
+            if not part:
+                continue
             if part.startswith('$$') and part.endswith('$$'):
                 # Block LaTeX formula
-                latex_content = part[2:-2].strip()
-                self.insert_latex_image(latex_content, block_mode=True)
-                
+                self.build_latex_segments(part[2:-2].strip(), True, segments)
             elif part.startswith('$') and part.endswith('$'):
                 # Inline LaTeX formula
-                latex_content = part[1:-1].strip()
-                self.insert_latex_image(latex_content, block_mode=False)
+                self.build_latex_segments(part[1:-1].strip(), False, segments)
             else:
                 # Regular text
-                self.chat_display.insert(tk.END, part, message_tag)
+                segments.append(('text', part, message_tag))
 
-        self.chat_display.insert(tk.END, '\n\n') # Add spacing after each message
-        self.chat_display.config(state='disabled')
-        self.chat_display.see(tk.END)
+        segments.append(('text', '\n\n', ())) # Add spacing after each message
+        return segments
+
+    def build_latex_segments(self, latex_string, block_mode, segments):
+        """Dokłada segmenty formuły (obrazek lub komunikat błędu)"""
+        tk_image = self.render_latex_image(latex_string, block_mode)
+        if tk_image is None:
+            segments.append(('text', f"[BŁĄD LaTeX: {latex_string}]", 'error'))
+        elif block_mode:
+            segments.append(('text', '\n', ())) # New line before block equation
+            segments.append(('image', tk_image))
+            segments.append(('text', '\n', ())) # New line after block equation
+        else:
+            segments.append(('image', tk_image))
+
+    def insert_segments(self, segments, tab):
+        """
+        Wstawia segmenty na koniec widżetu karty.
+        Kolejne fragmenty tekstu są łączone w jedno wywołanie
+        insert(END, tekst1, tagi1, tekst2, tagi2, ...), obrazki wymagają osobnego image_create.
+        """
+        pending = []
+        for segment in segments:
+            if segment[0] == 'text':
+                pending.extend(segment[1:])
+                continue
+            if pending:
+                tab.chat_display.insert(tk.END, *pending)
+                pending = []
+            tab.chat_display.image_create(tk.END, image=segment[1])
+            tab.rendered_images.append(segment[1]) # Keep a reference to prevent garbage collection
+        if pending:
+            tab.chat_display.insert(tk.END, *pending)
+
+    def render_latex_image(self, latex_string, block_mode=False):
+        """
+        Renderuje formułę LaTeX do PhotoImage.
+        Wyniki są cache'owane, więc powtarzające się formuły renderujemy tylko raz.
+        Zwraca None w razie błędu renderowania.
+        """
+        key = (latex_string, block_mode)
+        cached = self.latex_cache.get(key)
+        if cached is not None:
+            self.latex_cache.move_to_end(key)
+            return cached[0]
 
-    def insert_latex_image(self, latex_string, block_mode=False):
-        """Renders a LaTeX string to a PIL Image and inserts it into the Text widget."""
-        fig = None # Inicjalizacja fig na None na wypadek błędu przed utworzeniem
         try:
+            Figure = load_math_renderer()
+
             # Create a new figure for rendering
             # Adjust figsize and dpi based on desired output size and clarity
             # Block mode might need larger figure/fontsize
@@ -910,24 +4155,22 @@ class GeminiChatApp:
                 # Lepsza heurystyka dla wysokości w block_mode może być potrzebna,
                 # ale na razie zostawiamy Twoją logikę.
                 fig_height = 0.5 + (latex_string.count('\\\\') * 0.3) # Adjust height for multiline equations
-                font_size = 18
+                font_size = LATEX_FONT_SIZE_BLOCK
             else:
                 # Dynamiczna szerokość dla inline, może wymagać dalszych testów
                 fig_width = 0.8 + (len(latex_string) * 0.08)
                 fig_height = 0.3 # Height for inline
-                font_size = 14
+                font_size = LATEX_FONT_SIZE_INLINE
 
             # Zwiększone DPI dla lepszej jakości, ale może zwiększyć rozmiar obrazka
-            fig = plt.figure(figsize=(fig_width, fig_height), dpi=150) # Zwiększono DPI do 150
+            fig = Figure(figsize=(fig_width, fig_height), dpi=LATEX_DPI)
             
             # Use fig.add_subplot to get an Axes object for text placement
             ax = fig.add_subplot(111)
             ax.set_axis_off() # Hide axes
 
             # Render LaTeX text
-            # Upewnij się, że string jest poprawnie otoczony $ dla trybu matematycznego
-            # matplotlib oczekuje LaTeX-a w formacie matematycznym, np. $...$ lub $$...$$
-            # Jeśli latex_string już zawiera $ (np. z wejścia użytkownika), może to być problematyczne.
+            # matplotlib oczekuje LaTeX-a w formacie matematycznym, np. $...$
             # Zakładam, że latex_string to surowy kod LaTeX-a, który ma być osadzony w trybie matematycznym.
             ax.text(0.5, 0.5, f"${latex_string}$", # Re-add $ for matplotlib's LaTeX processing
                             horizontalalignment='center',
@@ -936,42 +4179,33 @@ class GeminiChatApp:
                             color='black',
                             usetex=True) # Crucial for LaTeX rendering
 
-            # Usunięcie zbędnych białych marginesów
-            # plt.savefig z bbox_inches='tight' jest zazwyczaj wystarczające.
-            # fig.subplots_adjust(left=0, right=1, top=1, bottom=0, wspace=0, hspace=0)
-            
             # Save to an in-memory buffer
             buf = io.BytesIO()
-            # Użyj facecolor='none' dla przezroczystości (jeśli to możliwe w zależności od backendu)
             # bbox_inches='tight' i pad_inches=0.01 kontrolują marginesy wokół renderowanego obrazu.
-            plt.savefig(buf, format='png', bbox_inches='tight', pad_inches=0.01, transparent=True)
+            fig.savefig(buf, format='png', bbox_inches='tight', pad_inches=0.01, transparent=True)
             buf.seek(0) # Rewind the buffer to the beginning
+            png_bytes = buf.getvalue() # Kept for reuse by the exporter
             
             # Convert buffer to PhotoImage
             pil_image = Image.open(buf)
             tk_image = ImageTk.PhotoImage(pil_image)
-            self.rendered_images.append(tk_image) # Keep a reference to prevent garbage collection
-
-            # Insert image into Text widget
-            if block_mode:
-                self.chat_display.insert(tk.END, '\n') # New line before block equation
-                self.chat_display.image_create(tk.END, image=tk_image)
-                self.chat_display.insert(tk.END, '\n') # New line after block equation
-            else:
-                self.chat_display.image_create(tk.END, image=tk_image)
 
         except Exception as e:
             print(f"Error rendering LaTeX: {e}")
-            self.chat_display.insert(tk.END, f"[BŁĄD LaTeX: {latex_string}]", 'error')
-        finally:
-            # ZAWSZE zamykaj figurę, aby zwolnić zasoby
-            if fig is not None:
-                plt.close(fig)
+            return None
+
+        self.cache_formula_image(key, tk_image, png_bytes)
+        return tk_image
+
+    def cache_formula_image(self, key, tk_image, png_bytes):
+        self.latex_cache[key] = (tk_image, png_bytes)
+        if len(self.latex_cache) > LATEX_CACHE_SIZE:
+            self.latex_cache.popitem(last=False)
     
     # === Metody pomocnicze ===
     def confirm_exit(self):
         """Potwierdza zamknięcie aplikacji"""
-        if (self.conversation_history and 
+        if (any(tab.dirty or tab.generating for tab in self.tabs.values()) and 
             not messagebox.askyesno(
                 "Potwierdzenie",
                 "Czy na pewno chcesz wyjść?\nNie zapisane dane zostaną utracone."
@@ -981,20 +4215,40 @@ class GeminiChatApp:
         self.root.destroy()
 
 if __name__ == "__main__":
-    # Configure Matplotlib for LaTeX rendering (requires a LaTeX distribution like TeX Live/MiKTeX)
-    # This block should be uncommented if you have a LaTeX distribution installed.
-    try:
-        plt.rcParams['text.usetex'] = True
-        plt.rcParams['font.family'] = 'serif'
-        plt.rcParams['font.serif'] = 'Computer Modern Roman' # Or 'Latin Modern Roman'
-    except Exception as e:
-        print(f"Warning: LaTeX configuration for Matplotlib failed. Ensure you have a LaTeX distribution (e.g., MiKTeX, TeX Live) installed and properly configured in your PATH. Math will be rendered as plain text or cause errors: {e}")
-        # Optionally, you might want to show a messagebox or disable LaTeX rendering if it fails.
-        # For now, we'll let it try and fail gracefully within display_message.
+    # Required for the export process pool in the frozen (PyInstaller) build
+    multiprocessing.freeze_support()
+
+    if "--serve" in sys.argv[1:]:
+        run_server(sys.argv[1:])
+        sys.exit(0)
+
+    if "--migrate-conversations" in sys.argv[1:]:
+        # Jednorazowe przepisanie zapisanych konwersacji do bieżącego formatu
+        migrate_conversations(os.path.join(Path(__file__).parent, CONVERSATIONS_DIR))
+        sys.exit(0)
+
+    if "--benchmark-history" in sys.argv[1:]:
+        # python app.py --benchmark-history [liczba wiadomości]
+        position = sys.argv.index("--benchmark-history")
+        arguments = sys.argv[position + 1:position + 2]
+        benchmark_history_index(int(arguments[0]) if arguments and arguments[0].isdigit() else 100_000)
+        sys.exit(0)
 
     root = tk.Tk()
     try:
         app = GeminiChatApp(root)
+        if "--startup-check" in sys.argv[1:]:
+            # Pomiar zimnego startu (build_report.py): zamykamy okno, gdy tylko jest gotowe
+            root.after_idle(lambda: (
+                print(f"matplotlib loaded: {'matplotlib' in sys.modules}"),
+                root.destroy()
+            ))
+        if "--benchmark-display" in sys.argv[1:]:
+            # python app.py --benchmark-display [liczba wiadomości]
+            position = sys.argv.index("--benchmark-display")
+            arguments = sys.argv[position + 1:position + 2]
+            count = int(arguments[0]) if arguments and arguments[0].isdigit() else 1000
+            root.after_idle(lambda: (benchmark_display(app, count), root.destroy()))
         root.mainloop()
     except Exception as e:
         messagebox.showerror(
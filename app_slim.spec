@@ -0,0 +1,100 @@
+# -*- mode: python ; coding: utf-8 -*-
+# Slim build profile: `pyinstaller app_slim.spec`
+#
+# Compared to app.spec it leaves out the packages the full build picks up
+# transitively (IPython, pandas, scipy, Qt, ...), ships matplotlib with the
+# Agg/SVG backends and the fonts needed for formulas only, and drops the
+# offline API discovery documents (google-generativeai fetches its discovery
+# document at runtime). matplotlib is imported lazily by app.py, so the chat
+# window starts without it. Use build_report.py to compare both builds.
+
+EXCLUDES = [
+    # GUI toolkits and backends other than Tk/Agg
+    'PyQt5', 'PyQt6', 'PySide2', 'PySide6', 'wx', 'gi',
+    'matplotlib.backends.backend_qt', 'matplotlib.backends.backend_qtagg',
+    'matplotlib.backends.backend_qtcairo', 'matplotlib.backends.backend_qt5',
+    'matplotlib.backends.backend_qt5agg', 'matplotlib.backends.backend_qt5cairo',
+    'matplotlib.backends.backend_tkagg', 'matplotlib.backends.backend_tkcairo',
+    'matplotlib.backends.backend_gtk3', 'matplotlib.backends.backend_gtk3agg',
+    'matplotlib.backends.backend_gtk4', 'matplotlib.backends.backend_gtk4agg',
+    'matplotlib.backends.backend_wx', 'matplotlib.backends.backend_wxagg',
+    'matplotlib.backends.backend_webagg', 'matplotlib.backends.backend_nbagg',
+    'matplotlib.backends.backend_macosx', 'matplotlib.backends.backend_pgf',
+    'matplotlib.backends.backend_cairo',
+    # Interactive shells and scientific stack not used by the app
+    'IPython', 'jedi', 'parso', 'zmq', 'tornado', 'jupyter_client', 'ipykernel',
+    'pandas', 'scipy', 'lxml', 'sympy',
+    # Test suites
+    'matplotlib.tests', 'numpy.tests', 'PIL.tests', 'tkinter.test',
+]
+
+# mpl-data that is never used when rendering formulas with Agg/SVG
+MPL_DATA_DROP = (
+    'matplotlib/mpl-data/sample_data/',
+    'matplotlib/mpl-data/images/',
+    'matplotlib/mpl-data/plot_directive/',
+    'matplotlib/mpl-data/fonts/afm/',
+    'matplotlib/mpl-data/fonts/pdfcorefonts/',
+)
+# Fonts kept: DejaVu Sans (default mathtext font) and Computer Modern (cm fontset)
+MPL_FONTS_KEEP = ('DejaVuSans.', 'DejaVuSans-', 'cm', 'LICENSE')
+
+
+def keep_data(dest):
+    dest = dest.replace('\\', '/')
+    if dest.startswith('googleapiclient/discovery_cache/documents/'):
+        return False
+    if dest.startswith(MPL_DATA_DROP):
+        return False
+    if dest.startswith('matplotlib/mpl-data/fonts/ttf/'):
+        return dest.rsplit('/', 1)[-1].startswith(MPL_FONTS_KEEP)
+    return True
+
+
+a = Analysis(
+    ['app.py'],
+    pathex=[],
+    binaries=[],
+    datas=[],
+    hiddenimports=[
+        'matplotlib.backends.backend_agg',
+        'matplotlib.backends.backend_svg',
+    ],
+    hookspath=[],
+    hooksconfig={
+        'matplotlib': {'backends': ['Agg', 'SVG']},
+    },
+    runtime_hooks=[],
+    excludes=EXCLUDES,
+    noarchive=False,
+    optimize=1,
+)
+a.datas = [entry for entry in a.datas if keep_data(entry[0])]
+pyz = PYZ(a.pure)
+
+exe = EXE(
+    pyz,
+    a.scripts,
+    [],
+    exclude_binaries=True,
+    name='app_slim',
+    debug=False,
+    bootloader_ignore_signals=False,
+    strip=False,
+    upx=True,
+    console=False,
+    disable_windowed_traceback=False,
+    argv_emulation=False,
+    target_arch=None,
+    codesign_identity=None,
+    entitlements_file=None,
+)
+coll = COLLECT(
+    exe,
+    a.binaries,
+    a.datas,
+    strip=False,
+    upx=True,
+    upx_exclude=[],
+    name='app_slim',
+)
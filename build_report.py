@@ -0,0 +1,86 @@
+"""
+Porównanie pełnej (app.spec) i odchudzonej (app_slim.spec) wersji aplikacji:
+rozmiar katalogu dist i czas zimnego startu (do gotowego okna).
+
+Użycie:
+    python build_report.py [--build] [--runs 5]
+
+--build najpierw buduje obie wersje PyInstallerem. Pomiar startu uruchamia
+aplikację z flagą --startup-check, która zamyka okno, gdy tylko jest gotowe
+(obok aplikacji musi leżeć api_key.txt, inaczej start czeka na podanie klucza).
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+BUILDS = [
+    # (nazwa, plik spec, katalog dist, nazwa pliku wykonywalnego)
+    ("pełna", "app.spec", os.path.join("dist", "app"), "app"),
+    ("slim", "app_slim.spec", os.path.join("dist", "app_slim"), "app_slim"),
+]
+STARTUP_TIMEOUT = 120
+
+
+def build(spec):
+    subprocess.run(
+        [sys.executable, "-m", "PyInstaller", "--noconfirm", spec],
+        check=True
+    )
+
+
+def directory_size(path):
+    """Zwraca (rozmiar w bajtach, liczba plików)"""
+    total = files = 0
+    for directory, _, names in os.walk(path):
+        for name in names:
+            total += os.path.getsize(os.path.join(directory, name))
+            files += 1
+    return total, files
+
+
+def startup_times(executable, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(
+            [executable, "--startup-check"],
+            check=True,
+            timeout=STARTUP_TIMEOUT,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--build", action="store_true", help="zbuduj obie wersje przed pomiarem")
+    parser.add_argument("--runs", type=int, default=5, help="liczba uruchomień do pomiaru startu")
+    args = parser.parse_args()
+
+    rows = []
+    for name, spec, dist_dir, exe_name in BUILDS:
+        if args.build:
+            build(spec)
+        executable = os.path.join(dist_dir, exe_name + (".exe" if os.name == "nt" else ""))
+        if not os.path.exists(executable):
+            rows.append((name, None, None, None, None))
+            continue
+        size, files = directory_size(dist_dir)
+        times = startup_times(executable, args.runs)
+        rows.append((name, size, files, min(times), statistics.median(times)))
+
+    print(f"{'Wersja':<8} {'Rozmiar [MB]':>12} {'Pliki':>7} {'Start min [s]':>14} {'Start mediana [s]':>18}")
+    for name, size, files, best, median in rows:
+        if size is None:
+            print(f"{name:<8} {'brak builda - uruchom z --build':>62}")
+            continue
+        print(f"{name:<8} {size / 1e6:>12.1f} {files:>7} {best:>14.2f} {median:>18.2f}")
+
+
+if __name__ == "__main__":
+    main()